@@ -0,0 +1,416 @@
+# coding:utf-8
+
+import hashlib
+import json
+import re
+import zlib
+from collections import defaultdict
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from db import (BATCH_SIZE, Collocation, CollocationMarker, CollocationRebuild, CollocationShard,
+                Document, DocumentCollocations, user_namespace)
+from process import NUM_COLLOCATIONS, Processor
+
+REFILL_BATCH_SIZE = 10
+# entity groups a cross-group transaction may use
+TRANSACTION_SIZE = 25
+# concurrent transactions of a document update
+TRANSACTIONS_IN_FLIGHT = 10
+# hex digits of the collocation digests kept per document
+DIGEST_SIZE = 10
+
+# rebuild pipeline: fanout pages through documents and enqueues a shard
+# task per SHARD_SIZE documents; shards split their collocations into
+# NUM_PARTITIONS by word; one merge task per partition writes them.
+# Shard and merge tasks each record their completion in a
+# CollocationMarker; the task finding a stage complete advances the
+# rebuild.
+QUEUE_NAME = 'collocation'
+FANOUT_PAGE_SIZE = 100
+SHARD_SIZE = 10
+NUM_PARTITIONS = 8
+# JSON bytes per CollocationShard, well below the 1MB entity limit
+# before compression
+SHARD_PART_SIZE = 512 * 1024
+
+
+def document_collocations(text):
+    text = re.sub(r'[\r\n]', ' ', text)
+    return Processor.build_collocation(text, defaultdict(list))
+
+
+def add_document(coll, document_id, collocations):
+    room = NUM_COLLOCATIONS - len(coll.entries)
+    coll.entries.extend([document_id, c] for c in collocations[:room])
+    if len(collocations) > room:
+        coll.complete = False
+    coll.documents.append(document_id)
+
+
+def insert_document(coll, document_id, collocations, rank):
+    """Adds a document before the documents ranked after it, as a rebuild does."""
+    position = len(coll.documents)
+    for i, id in enumerate(coll.documents):
+        if rank(id) > rank(document_id):
+            position = i
+            break
+    before = set(coll.documents[:position])
+    start = sum(1 for entry in coll.entries if entry[0] in before)
+    coll.entries[start:start] = [[document_id, c] for c in collocations]
+    if len(coll.entries) > NUM_COLLOCATIONS:
+        del coll.entries[NUM_COLLOCATIONS:]
+        coll.complete = False
+    coll.documents.insert(position, document_id)
+
+
+def remove_document(coll, document_id):
+    coll.entries = [entry for entry in coll.entries if entry[0] != document_id]
+    if document_id in coll.documents:
+        coll.documents.remove(document_id)
+
+
+def refill(colls):
+    """Refills incomplete collocations from their documents, in order."""
+    cache = {}
+    for coll in colls:
+        document_ids = coll.documents
+        coll.entries = []
+        coll.documents = []
+        coll.complete = True
+        for i, document_id in enumerate(document_ids):
+            if len(coll.entries) >= NUM_COLLOCATIONS:
+                coll.documents.extend(document_ids[i:])
+                coll.complete = False
+                break
+            if document_id not in cache:
+                ids = [id for id in document_ids[i:i + REFILL_BATCH_SIZE] if id not in cache]
+                for id, document in zip(ids, get_documents(ids)):
+                    if document is not None:
+                        cache[id] = document_collocations(document.content)
+                    else:
+                        cache[id] = {}
+            collocations = cache[document_id].get(coll.name)
+            if collocations:
+                add_document(coll, document_id, collocations)
+
+
+@ndb.non_transactional
+def get_documents(ids):
+    # outside the transaction, which may only use TRANSACTION_SIZE groups
+    return Document.get_multi_with_namespace(ids)
+
+
+def enqueue_document(document):
+    """Enqueues the update of the collocations of a saved or deleted document."""
+    params = {
+        'namespace': user_namespace(),
+        'id': document.key.id(),
+        'revision': document.revision,
+    }
+    taskqueue.add(url='/tasks/collocation/document', params=params, queue_name=QUEUE_NAME)
+
+
+def collocation_digests(collocations):
+    return dict((name, hashlib.sha1(json.dumps(found)).hexdigest()[:DIGEST_SIZE])
+                for name, found in collocations.iteritems())
+
+
+def update_document(document_id, revision):
+    """Replaces the collocations contributed by a document.
+
+    Runs in a task after the document was saved or deleted. The words
+    to rewrite are found against the digests stored for the previous
+    revision; a document saved before they were stored contributes its
+    stale words until a rebuild. The collocations are updated in
+    transactions, so documents saved at the same time do not drop each
+    other's entries.
+    """
+    document = Document.get_with_namespace(document_id)
+    if document is not None and document.revision != revision:
+        # the task of the later revision does the update
+        return
+    state = DocumentCollocations.get_with_namespace(document_id)
+    if state is not None and state.revision > revision:
+        return
+    old = state.digests if state is not None else {}
+    new = document_collocations(document.content) if document is not None else {}
+    digests = collocation_digests(new)
+    names = [name for name in set(old) | set(digests) if old.get(name) != digests.get(name)]
+    if names:
+        # newest first, the order of a rebuild; the query may miss a new document
+        order = dict((id, i) for i, id in enumerate(Document.get_ids_by_date_with_namespace()))
+
+        def rank(id):
+            return order.get(id, -1 if id == document_id else len(order))
+
+        batches = [names[i:i + TRANSACTION_SIZE] for i in range(0, len(names), TRANSACTION_SIZE)]
+        for i in range(0, len(batches), TRANSACTIONS_IN_FLIGHT):
+            futures = [update_collocations(batch, document_id, new, rank)
+                       for batch in batches[i:i + TRANSACTIONS_IN_FLIGHT]]
+            for future in futures:
+                future.get_result()
+        Collocation.touch_with_namespace()
+    if document is None:
+        DocumentCollocations.delete_with_namespace(document_id)
+    else:
+        save_digests(document_id, revision, digests)
+
+
+@ndb.transactional
+def save_digests(document_id, revision, digests):
+    state = DocumentCollocations.get_with_namespace(document_id)
+    if state is None or state.revision < revision:
+        DocumentCollocations.put_multi_with_namespace([DocumentCollocations(
+            id=document_id, namespace=user_namespace(), revision=revision, digests=digests)])
+
+
+@ndb.transactional_tasklet(xg=True)
+def update_collocations(names, document_id, new, rank):
+    colls = yield Collocation.get_multi_by_name_with_namespace_async(names)
+    colls = [coll if coll is not None else Collocation.new(name)
+             for name, coll in zip(names, colls)]
+    incomplete = []
+    for coll in colls:
+        if coll.entries is None:
+            # stored before entries were tracked; fixed by a full update
+            coll.entries = []
+            coll.documents = []
+        remove_document(coll, document_id)
+        if coll.name in new:
+            insert_document(coll, document_id, new[coll.name], rank)
+        if not coll.complete and len(coll.entries) < NUM_COLLOCATIONS:
+            incomplete.append(coll)
+    refill(incomplete)
+    yield (Collocation.put_multi_with_namespace_async([coll for coll in colls if coll.documents]) +
+           Collocation.delete_multi_with_namespace_async([coll for coll in colls
+                                                          if not coll.documents]))
+
+
+def partition(name):
+    return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % NUM_PARTITIONS
+
+
+def shard_key(rebuild_key, shard, partition, part):
+    return ndb.Key(CollocationShard, '%d-%d-%d-%d' % (rebuild_key.id(), shard, partition, part),
+                   namespace=rebuild_key.namespace())
+
+
+def split_part(collocations, size=SHARD_PART_SIZE):
+    """Splits the collocations of a partition into dicts of about size bytes."""
+    parts = []
+    length = 0
+    for name, documents in collocations.iteritems():
+        entry_size = len(json.dumps(documents)) + len(name)
+        if not parts or (parts[-1] and length + entry_size > size):
+            parts.append({})
+            length = 0
+        parts[-1][name] = documents
+        length += entry_size
+    return parts
+
+
+def enqueue(rebuild_key, stage, params, name=None, transactional=False):
+    params = dict(params, rebuild=rebuild_key.urlsafe())
+    if name is not None:
+        # named tasks are not enqueued twice when a stage is retried
+        name = '%s-%s' % (rebuild_key.urlsafe(), name)
+    try:
+        taskqueue.add(url='/tasks/collocation/' + stage, params=params, name=name,
+                      queue_name=QUEUE_NAME, transactional=transactional)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def start_rebuild():
+    rebuild = CollocationRebuild(namespace=user_namespace())
+    rebuild.status = 'running'
+    rebuild.num_partitions = NUM_PARTITIONS
+    rebuild.put()
+    enqueue(rebuild.key, 'fanout', {'cursor': '', 'shard': 0}, name='fanout-0')
+    return rebuild
+
+
+def marker_key(rebuild_key, stage, number):
+    return ndb.Key(CollocationMarker, '%d-%s-%d' % (rebuild_key.id(), stage, number),
+                   namespace=rebuild_key.namespace())
+
+
+def mark_done(rebuild_key, stage, number, count, parts=()):
+    CollocationMarker(key=marker_key(rebuild_key, stage, number), rebuild=rebuild_key,
+                      stage=stage, count=count, parts=list(parts)).put()
+
+
+def get_markers(rebuild_key, stage, total):
+    keys = [marker_key(rebuild_key, stage, number) for number in range(total)]
+    markers = []
+    for i in range(0, len(keys), BATCH_SIZE):
+        markers.extend(ndb.get_multi(keys[i:i + BATCH_SIZE]))
+    return markers
+
+
+def marker_query(rebuild_key, stage):
+    return CollocationMarker.query(CollocationMarker.rebuild == rebuild_key,
+                                   CollocationMarker.stage == stage,
+                                   namespace=rebuild_key.namespace())
+
+
+def count_done(rebuild_key, stage):
+    """Returns about the number of done tasks of stage, for progress only."""
+    return marker_query(rebuild_key, stage).count()
+
+
+def stage_done(rebuild_key, stage, total):
+    """Whether the tasks 0 to total - 1 of stage are all done.
+
+    The keys-only query is eventually consistent, so the markers it does
+    not return are looked up by key before concluding one is missing.
+    """
+    found = set(key.id() for key in
+                marker_query(rebuild_key, stage).iter(keys_only=True, batch_size=BATCH_SIZE))
+    missing = [marker_key(rebuild_key, stage, number) for number in range(total)]
+    missing = [key for key in missing if key.id() not in found]
+    for i in range(0, len(missing), BATCH_SIZE):
+        if None in ndb.get_multi(missing[i:i + BATCH_SIZE]):
+            return False
+    return True
+
+
+def check_rebuild(rebuild_key):
+    """Advances the rebuild once every task of its current stage is done."""
+    rebuild = rebuild_key.get()
+    if rebuild.status == 'running' and rebuild.fanout_done:
+        status, stage, total = 'running', 'shard', rebuild.num_shards
+    elif rebuild.status == 'merging':
+        status, stage, total = 'merging', 'merge', rebuild.num_partitions
+    else:
+        return
+    if not stage_done(rebuild_key, stage, total):
+        return
+    count = sum(marker.count for marker in get_markers(rebuild_key, stage, total))
+
+    @ndb.transactional
+    def txn():
+        rebuild = rebuild_key.get()
+        if rebuild.status != status:
+            return False
+        if status == 'running':
+            rebuild.status = 'merging'
+            rebuild.num_documents = count
+            enqueue(rebuild_key, 'merge', {'partition': -1}, transactional=True)
+        else:
+            rebuild.status = 'done'
+            rebuild.num_collocations = count
+        rebuild.put()
+        return True
+
+    if txn() and status == 'merging':
+        keys = ([marker_key(rebuild_key, 'shard', number) for number in range(rebuild.num_shards)] +
+                [marker_key(rebuild_key, 'merge', number) for number in range(total)])
+        for i in range(0, len(keys), BATCH_SIZE):
+            ndb.delete_multi(keys[i:i + BATCH_SIZE])
+
+
+def progress(rebuild):
+    """Returns the numbers of done shards and partitions of a rebuild."""
+    if rebuild.status == 'done':
+        # the markers are deleted once the rebuild is done
+        return rebuild.num_shards, rebuild.num_partitions
+    if rebuild.status == 'merging':
+        return rebuild.num_shards, count_done(rebuild.key, 'merge')
+    return count_done(rebuild.key, 'shard'), 0
+
+
+def fanout(rebuild_key, cursor, shard):
+    query = Document.query(namespace=rebuild_key.namespace()).order(-Document.date)
+    start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    keys, next_cursor, more = query.fetch_page(FANOUT_PAGE_SIZE, start_cursor=start_cursor,
+                                               keys_only=True)
+    ids = [key.id() for key in keys]
+    for i in range(0, len(ids), SHARD_SIZE):
+        params = {'shard': shard, 'ids': ','.join(str(id) for id in ids[i:i + SHARD_SIZE])}
+        enqueue(rebuild_key, 'shard', params, name='shard-%d' % shard)
+        shard += 1
+    if more and next_cursor is not None:
+        params = {'cursor': next_cursor.urlsafe(), 'shard': shard}
+        enqueue(rebuild_key, 'fanout', params, name='fanout-%d' % shard)
+        return
+
+    @ndb.transactional
+    def txn():
+        rebuild = rebuild_key.get()
+        rebuild.fanout_done = True
+        rebuild.num_shards = shard
+        rebuild.put()
+
+    txn()
+    check_rebuild(rebuild_key)
+
+
+def process_shard(rebuild_key, shard, ids):
+    if rebuild_key.get().status != 'running':
+        # a retry after the shards were merged
+        return
+    namespace = rebuild_key.namespace()
+    documents = ndb.get_multi([ndb.Key(Document, id, namespace=namespace) for id in ids])
+    partitions = [defaultdict(list) for _ in range(NUM_PARTITIONS)]
+    states = []
+    for document in documents:
+        if document is None:
+            continue
+        found = document_collocations(document.content)
+        for name, collocations in found.iteritems():
+            partitions[partition(name)][name].append([document.key.id(), collocations])
+        # the digests later updates of the document compare against
+        states.append(DocumentCollocations(id=document.key.id(), namespace=namespace,
+                                           revision=document.revision,
+                                           digests=collocation_digests(found)))
+    parts = [split_part(collocations) for collocations in partitions]
+    ndb.put_multi([CollocationShard(key=shard_key(rebuild_key, shard, i, j), collocations=part)
+                   for i, partition_parts in enumerate(parts)
+                   for j, part in enumerate(partition_parts)] + states)
+    mark_done(rebuild_key, 'shard', shard, len(states), [len(part) for part in parts])
+    check_rebuild(rebuild_key)
+
+
+def merge(rebuild_key, number):
+    rebuild = rebuild_key.get()
+    if rebuild.status != 'merging':
+        # a retry after the rebuild was done
+        return
+    if number < 0:
+        # enqueued once when all shards are done
+        for i in range(rebuild.num_partitions):
+            enqueue(rebuild_key, 'merge', {'partition': i}, name='merge-%d' % i)
+        return
+
+    colls = {}
+    keys = [shard_key(rebuild_key, shard, number, part)
+            for shard, marker in enumerate(get_markers(rebuild_key, 'shard', rebuild.num_shards))
+            for part in range(marker.parts[number])]
+    for i in range(0, len(keys), BATCH_SIZE):
+        for shard in ndb.get_multi(keys[i:i + BATCH_SIZE]):
+            if shard is None:
+                continue
+            for name, documents in shard.collocations.iteritems():
+                if name not in colls:
+                    colls[name] = Collocation.new(name)
+                for document_id, collocations in documents:
+                    add_document(colls[name], document_id, collocations)
+    # words of the partition no longer in any document
+    query = Collocation.query(namespace=rebuild_key.namespace())
+    stale = [key for key in query.iter(keys_only=True, batch_size=BATCH_SIZE)
+             if key.string_id() is not None and key.string_id() not in colls and
+             partition(key.string_id()) == number]
+    for i in range(0, len(stale), BATCH_SIZE):
+        ndb.delete_multi(stale[i:i + BATCH_SIZE])
+    colls = colls.values()
+    for i in range(0, len(colls), BATCH_SIZE):
+        ndb.put_multi(colls[i:i + BATCH_SIZE])
+    Collocation.touch_with_namespace()
+    for i in range(0, len(keys), BATCH_SIZE):
+        ndb.delete_multi(keys[i:i + BATCH_SIZE])
+    mark_done(rebuild_key, 'merge', number, len(colls))
+    check_rebuild(rebuild_key)
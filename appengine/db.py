@@ -1,11 +1,70 @@
+import contextlib
+from datetime import datetime, timedelta
+import os
 import string
+import threading
 
+from google.appengine.api import memcache
 from google.appengine.api import namespace_manager
 from google.appengine.api import users
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
+import lemmatize
+import search
+from formtable import FormTable
+
 NAMESPACE_TRANS = string.maketrans("!@#$%&'*+/=?^`{|}~", "------------------")
 
+LEXICON_ID = 'lexicon'
+LEXICON_CACHE_TIME = 60 * 60
+MAX_LEXICON_CHANGES = 1000
+# seconds a global query may lag behind a committed write
+QUERY_CONSISTENCY_DELAY = 30
+MAX_IN_VALUES = 30
+# entity groups of a cross-group transaction, less the lexicon
+MAX_TRANSACTION_WORDS = 24
+BATCH_SIZE = 500
+# bytes per memcache value of a cached FormTable, below the 1MB limit
+FORMS_PART_SIZE = 900 * 1024
+# word changes cached on top of a FormTable before it is stored again
+MAX_CACHED_CHANGES = 500
+COLLOCATION_GENERATION_KEY = 'collocations:generation'
+
+_local = threading.local()
+
+
+def user_namespace():
+    """Returns the namespace of the current user, resolved once per request."""
+    namespace = getattr(_local, 'override', None)
+    if namespace is not None:
+        return namespace
+    request_id = os.environ.get('REQUEST_LOG_ID')
+    if request_id is None or getattr(_local, 'request_id', None) != request_id:
+        user = users.get_current_user()
+        _local.namespace = user.email().translate(NAMESPACE_TRANS)
+        _local.request_id = request_id
+    return _local.namespace
+
+
+@contextlib.contextmanager
+def namespace_context(namespace=None):
+    """Runs a block in a namespace, the current user's by default.
+
+    Task handlers, which have no user, pass the namespace explicitly.
+    """
+    if namespace is None:
+        namespace = user_namespace()
+    previous_namespace = namespace_manager.get_namespace()
+    previous_override = getattr(_local, 'override', None)
+    try:
+        namespace_manager.set_namespace(namespace)
+        _local.override = namespace
+        yield namespace
+    finally:
+        namespace_manager.set_namespace(previous_namespace)
+        _local.override = previous_override
+
 
 class Word(ndb.Model):
     """A model for representing a word."""
@@ -14,124 +73,229 @@ class Word(ndb.Model):
     content = ndb.TextProperty()
     known = ndb.BooleanProperty()
     date = ndb.DateTimeProperty(auto_now_add=True)
+    # the search index, written and removed with the word itself
+    grams = ndb.ComputedProperty(lambda self: search.grams(self.search_terms()), repeated=True)
+
+    def search_terms(self):
+        return search.terms(self.name, self.conjugative, self.content)
 
     @classmethod
-    def new(cls):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            word = Word()
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
-        word.name = ''
+    def new(cls, name=''):
+        with namespace_context():
+            word = Word(id=name or None)
+        word.name = name
         word.content = ''
         return word
 
+    @classmethod
+    def get_all_with_namespace_async(cls):
+        with namespace_context():
+            return Word.query().order(Word.name).fetch_async()
+
     @classmethod
     def get_all_with_namespace(cls):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            qry = Word.query().order(Word.name)
-            words = qry.fetch()
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
-        return words
+        return cls.get_all_with_namespace_async().get_result()
+
+    @classmethod
+    def get_with_namespace_async(cls, id):
+        with namespace_context():
+            return Word.get_by_id_async(id)
 
     @classmethod
     def get_with_namespace(cls, id):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            word = Word.get_by_id(id)
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
-        return word
+        return cls.get_with_namespace_async(id).get_result()
 
     @classmethod
-    def get_by_name_or_new_with_namespace(cls, name):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            qry = Word.query(Word.name == name)
-            word = qry.get()
+    @ndb.tasklet
+    def get_multi_by_name_or_new_with_namespace_async(cls, names):
+        # resolved before yielding, other tasklets may switch namespaces
+        namespace = user_namespace()
+        words = yield ndb.get_multi_async([ndb.Key(Word, name, namespace=namespace)
+                                           for name in names])
+        new_words = []
+        for name, word in zip(names, words):
             if word is None:
-                word = Word()
+                word = Word(id=name, namespace=namespace)
                 word.name = name
                 word.content = ''
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
-        return word
+            new_words.append(word)
+        raise ndb.Return(new_words)
+
+    @classmethod
+    def get_multi_by_name_or_new_with_namespace(cls, names):
+        return cls.get_multi_by_name_or_new_with_namespace_async(names).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_or_new_with_namespace_async(cls, name):
+        words = yield cls.get_multi_by_name_or_new_with_namespace_async([name])
+        raise ndb.Return(words[0])
+
+    @classmethod
+    def get_by_name_or_new_with_namespace(cls, name):
+        return cls.get_by_name_or_new_with_namespace_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_with_collocations_async(cls, name):
+        word, coll = yield (cls.get_by_name_or_new_with_namespace_async(name),
+                            Collocation.get_by_name_with_namespace_async(name))
+        colls = [coll]
+        if word.conjugative:
+            colls += yield Collocation.get_multi_by_name_with_namespace_async(word.conjugative)
+        raise ndb.Return(word, [found for found in colls if found is not None])
+
+    @classmethod
+    def put_with_namespace_async(cls, word):
+        with namespace_context():
+            return word.put_async()
 
     @classmethod
     def put_with_namespace(cls, word):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            word.put()
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
+        return cls.put_with_namespace_async(word).get_result()
+
+    @classmethod
+    def put_multi_with_namespace_async(cls, words):
+        with namespace_context():
+            return ndb.put_multi_async(words)
 
     @classmethod
     def put_multi_with_namespace(cls, words):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            ndb.put_multi(words)
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
+        return [future.get_result() for future in cls.put_multi_with_namespace_async(words)]
+
+    @classmethod
+    def get_all_words_async(cls):
+        with namespace_context():
+            return Word.query().fetch_async()
 
     @classmethod
     def get_all_words(cls):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
+        return cls.get_all_words_async().get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def fetch_page_by_name_with_namespace_async(cls, size, cursor=None, known=None, prefix=''):
+        """Returns a page of words ordered by name and the next cursor."""
+        with namespace_context():
             qry = Word.query()
-            words = qry.fetch()
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
-        return words
+            if known is not None:
+                qry = qry.filter(Word.known == known)
+            if prefix:
+                qry = qry.filter(Word.name >= prefix, Word.name < prefix + u'\ufffd')
+            qry = qry.order(Word.name)
+            start_cursor = Cursor(urlsafe=cursor) if cursor else None
+            future = qry.fetch_page_async(size, start_cursor=start_cursor)
+        words, next_cursor, more = yield future
+        if not more or next_cursor is None:
+            raise ndb.Return(words, None)
+        raise ndb.Return(words, next_cursor.urlsafe())
 
     @classmethod
-    def get_all_known_words(cls):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            qry = Word.query(Word.known == True)
-            words = {}
-            for word in qry.fetch():
-                words[word.name] = word.name
-                if word.conjugative is not None:
-                    for conj in word.conjugative:
-                        words[conj] = word.name
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
-        return words
-
-    @classmethod
-    def get_all_unknown_words(cls):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            qry = Word.query(Word.known == False)
-            words = {}
-            for word in qry.fetch():
-                words[word.name] = word.name
-                if word.conjugative is not None:
-                    for conj in word.conjugative:
-                        words[conj] = word.name
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
-        return words
+    def fetch_page_by_name_with_namespace(cls, size, cursor=None, known=None, prefix=''):
+        return cls.fetch_page_by_name_with_namespace_async(size, cursor, known, prefix).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def search_with_namespace_async(cls, query, limit):
+        """Returns up to limit words starting with query, then containing it.
+
+        Prefixes are a range of the name keys; substrings of names and
+        conjugative forms are found through the grams, all queries
+        answered from the built-in indexes.
+        """
+        query = query.lower()
+        if not query:
+            raise ndb.Return([])
+        gram_future = None
+        with namespace_context():
+            prefix_future = Word.query(Word.key >= ndb.Key(Word, query),
+                                       Word.key < ndb.Key(Word, query + u'\ufffd')).fetch_async(limit)
+            if len(query) >= search.GRAM_SIZE:
+                filters = [Word.grams == gram for gram in search.query_grams(query)]
+                gram_future = Word.query(*filters).fetch_async(limit * search.OVERFETCH)
+        words = yield prefix_future
+        if gram_future is not None and len(words) < limit:
+            names = set(word.name for word in words)
+            for word in (yield gram_future):
+                if len(words) >= limit:
+                    break
+                if word.name not in names and search.matches(word.search_terms(), query):
+                    words.append(word)
+        raise ndb.Return(words)
+
+    @classmethod
+    def search_with_namespace(cls, query, limit):
+        return cls.search_with_namespace_async(query, limit).get_result()
+
+    @classmethod
+    def restore_with_namespace(cls, objs):
+        """Creates or updates words from backup objects.
+
+        The counters are updated with each batch of words, but the
+        version is not: the caller bumps it once for the changed forms.
+        Returns the numbers of created, updated and unchanged words and
+        the changed forms.
+        """
+        words = []
+        changes = []
+        states = []
+        created = updated = unchanged = 0
+        names = [obj['name'] for obj in objs]
+        for obj, word in zip(objs, cls.get_multi_by_name_or_new_with_namespace(names)):
+            date = datetime.strptime(obj['date'], '%Y/%m/%d %H:%M:%S')
+            if word.date is None:
+                created += 1
+            elif (word.conjugative == obj['conjugative'] and word.content == obj['content'] and
+                  word.known == obj['known'] and word.date == date):
+                unchanged += 1
+                continue
+            else:
+                updated += 1
+            old_forms = Lexicon.word_forms(word)
+            states.append((Lexicon.word_state(word), bool(obj['known'])))
+            word.conjugative = obj['conjugative']
+            word.content = obj['content']
+            word.known = obj['known']
+            word.date = date
+            words.append(word)
+            changes.append((old_forms, Lexicon.word_forms(word)))
+        for i in range(0, len(words), BATCH_SIZE):
+            batch = slice(i, i + BATCH_SIZE)
+            cls.put_multi_with_namespace(words[batch])
+            Lexicon.add_counts_with_namespace(states[batch])
+        return (created, updated, unchanged), Lexicon.changed_forms(changes)
+
+    @classmethod
+    def migrate_keys_with_namespace(cls, cursor=None):
+        """Re-keys a page of words stored under numeric ids by their names.
+
+        Returns the number of re-keyed words and the cursor of the next
+        page, or None after the last one.
+        """
+        with namespace_context():
+            qry = Word.query()
+        words, cursor, more = qry.fetch_page(BATCH_SIZE, start_cursor=cursor)
+        old_words = [word for word in words if word.key.id() != word.name and word.name]
+        new_words = [Word(id=word.name, namespace=word.key.namespace(),
+                          **word.to_dict(exclude=['grams'])) for word in old_words]
+        # words saved under their names already are newer
+        existing = ndb.get_multi([word.key for word in new_words])
+        ndb.put_multi([word for word, saved in zip(new_words, existing) if saved is None])
+        ndb.delete_multi([word.key for word in old_words])
+        return len(old_words), cursor if more else None
+
+    @classmethod
+    def reindex_with_namespace(cls, cursor=None):
+        """Rewrites a page of words so that their search grams are stored.
+
+        Returns the number of words and the cursor of the next page, or
+        None after the last one.
+        """
+        with namespace_context():
+            qry = Word.query()
+        words, cursor, more = qry.fetch_page(BATCH_SIZE, start_cursor=cursor)
+        ndb.put_multi(words)
+        return len(words), cursor if more else None
 
 
 class Document(ndb.Model):
@@ -139,107 +303,823 @@ class Document(ndb.Model):
     title = ndb.StringProperty(indexed=False)
     content = ndb.TextProperty(indexed=False)
     date = ndb.DateTimeProperty(auto_now_add=True)
+    revision = ndb.IntegerProperty(default=0, indexed=False)
 
     @classmethod
     def new(cls):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
+        with namespace_context():
             document = Document()
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
         document.title = ''
         document.content = ''
         return document
 
+    @classmethod
+    def get_all_with_namespace_async(cls):
+        with namespace_context():
+            return Document.query().order(-Document.date).fetch_async()
+
     @classmethod
     def get_all_with_namespace(cls):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            documents_query = Document.query().order(-Document.date)
-            documents = documents_query.fetch()
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
-        return documents
+        return cls.get_all_with_namespace_async().get_result()
+
+    @classmethod
+    def get_ids_by_date_with_namespace(cls):
+        """Returns the ids of the documents, newest first."""
+        with namespace_context():
+            query = Document.query().order(-Document.date)
+            return [key.id() for key in query.iter(keys_only=True, batch_size=BATCH_SIZE)]
+
+    @classmethod
+    def get_with_namespace_async(cls, id):
+        with namespace_context():
+            return Document.get_by_id_async(id)
 
     @classmethod
     def get_with_namespace(cls, id):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            document = Document.get_by_id(id)
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
-        return document
+        return cls.get_with_namespace_async(id).get_result()
+
+    @classmethod
+    def get_multi_with_namespace_async(cls, ids):
+        with namespace_context():
+            return ndb.get_multi_async([ndb.Key(Document, id) for id in ids])
+
+    @classmethod
+    def get_multi_with_namespace(cls, ids):
+        return [future.get_result() for future in cls.get_multi_with_namespace_async(ids)]
+
+    @classmethod
+    @ndb.tasklet
+    def get_with_rendered_with_namespace_async(cls, id, section=0):
+        with namespace_context():
+            lexicon_key = ndb.Key(Lexicon, LEXICON_ID)
+            futures = ndb.get_multi_async([ndb.Key(Document, id),
+                                           RenderedDocument.key_for(id, section),
+                                           lexicon_key])
+        document, rendered, lexicon = yield futures
+        if lexicon is None:
+            lexicon = Lexicon(key=lexicon_key)
+        raise ndb.Return(document, rendered, lexicon)
+
+    @classmethod
+    def get_with_rendered_with_namespace(cls, id, section=0):
+        return cls.get_with_rendered_with_namespace_async(id, section).get_result()
+
+    @classmethod
+    def put_with_namespace_async(cls, document):
+        with namespace_context():
+            return document.put_async()
 
     @classmethod
     def put_with_namespace(cls, document):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            document.put()
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
+        return cls.put_with_namespace_async(document).get_result()
+
+    @classmethod
+    def delete_with_namespace_async(cls, document, num_sections=1):
+        with namespace_context(document.key.namespace()):
+            keys = [RenderedDocument.key_for(document.key.id(), section)
+                    for section in range(num_sections)]
+        return ndb.delete_multi_async([document.key] + keys)
+
+    @classmethod
+    def delete_with_namespace(cls, document, num_sections=1):
+        for future in cls.delete_with_namespace_async(document, num_sections):
+            future.get_result()
+
+
+class RenderedDocument(ndb.Model):
+    """A model for caching the rendered title and first section of a document.
+
+    It shares its id with the document and is valid as long as the
+    document revision is unchanged and none of its forms changed in the
+    lexicon since lexicon_version. Neutral renders carry no word states
+    and only depend on the revision.
+
+    lines holds [hash, html, words, known, unknown, new] for each line,
+    so a render of an edited revision reuses the unchanged lines.
+    num_sections is the number of sections of the document when its
+    first section was rendered, so the later ones can be found when it
+    shrinks.
+    """
+    revision = ndb.IntegerProperty(indexed=False)
+    lexicon_version = ndb.IntegerProperty(indexed=False)
+    neutral = ndb.BooleanProperty(default=False, indexed=False)
+    title = ndb.TextProperty()
+    lines = ndb.JsonProperty(compressed=True)
+    forms = ndb.JsonProperty(compressed=True)
+    count_words = ndb.IntegerProperty(indexed=False)
+    count_known_words = ndb.IntegerProperty(indexed=False)
+    count_unknown_words = ndb.IntegerProperty(indexed=False)
+    count_new_words = ndb.IntegerProperty(indexed=False)
+    num_sections = ndb.IntegerProperty(indexed=False)
+
+    @staticmethod
+    def key_for(document_id, section=0):
+        """Returns the key of the render of a section of a document.
+
+        The first section is rendered with the title when the document is
+        opened; the others are RenderedSections loaded as the reader scrolls.
+        """
+        if section == 0:
+            return ndb.Key(RenderedDocument, document_id)
+        return ndb.Key(RenderedSection, '%d-%d' % (document_id, section))
+
+    def is_current(self, document, lexicon, neutral=False):
+        return self.revision == document.revision and self.is_reusable(lexicon, neutral)
+
+    def is_reusable(self, lexicon, neutral=False):
+        """Returns whether the rendered lines are valid for the lexicon."""
+        if self.neutral != neutral:
+            return False
+        if neutral:
+            return True
+        return not lexicon.changed_since(self.lexicon_version, self.forms)
+
+    def html_lines(self):
+        return [entry[1] for entry in self.lines]
+
+    @classmethod
+    def get_with_namespace(cls, document_id):
+        with namespace_context():
+            return RenderedDocument.key_for(document_id).get()
+
+    @classmethod
+    def put_with_namespace_async(cls, rendered):
+        with namespace_context():
+            return rendered.put_async()
+
+    @classmethod
+    def put_with_namespace(cls, rendered):
+        return cls.put_with_namespace_async(rendered).get_result()
+
+    @classmethod
+    def delete_sections_with_namespace(cls, document_id, start, end):
+        with namespace_context():
+            keys = [RenderedDocument.key_for(document_id, section)
+                    for section in range(start, end)]
+        ndb.delete_multi(keys)
+
+
+class RenderedSection(RenderedDocument):
+    """A model for caching the rendered HTML of a later document section."""
 
 
 class Collocation(ndb.Model):
-    """A model for representing a collocation."""
+    """A model for representing a collocation.
+
+    entries holds [document id, collocation] pairs. complete is False when
+    some collocations of the documents were dropped to respect the limit.
+    """
     name = ndb.StringProperty()
     collocation = ndb.TextProperty()
+    entries = ndb.JsonProperty(compressed=True)
+    documents = ndb.IntegerProperty(repeated=True, indexed=False)
+    complete = ndb.BooleanProperty(default=True, indexed=False)
+
+    def _pre_put_hook(self):
+        if self.entries is not None:
+            self.collocation = '\n'.join(entry[1] for entry in self.entries)
 
     @classmethod
-    def get_with_namespace(cls, id):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            coll = Collocation.get_by_id(id)
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
+    def new(cls, name):
+        with namespace_context():
+            coll = Collocation(id=name)
+        coll.name = name
+        coll.collocation = ''
+        coll.entries = []
         return coll
 
+    @classmethod
+    def get_generation_with_namespace(cls):
+        """Returns a token replaced whenever the user's collocations change.
+
+        A lost token is replaced by a new random one rather than reset,
+        so a token never stands for two different sets of collocations.
+        """
+        namespace = user_namespace()
+        generation = memcache.get(COLLOCATION_GENERATION_KEY, namespace=namespace)
+        if generation is None:
+            memcache.add(COLLOCATION_GENERATION_KEY, os.urandom(8).encode('hex'),
+                         namespace=namespace)
+            generation = memcache.get(COLLOCATION_GENERATION_KEY, namespace=namespace)
+        # memcache unavailable; a token matching nothing
+        return generation or os.urandom(8).encode('hex')
+
+    @classmethod
+    def touch_with_namespace(cls):
+        memcache.set(COLLOCATION_GENERATION_KEY, os.urandom(8).encode('hex'),
+                     namespace=user_namespace())
+
+    @classmethod
+    def get_with_namespace_async(cls, id):
+        with namespace_context():
+            return Collocation.get_by_id_async(id)
+
+    @classmethod
+    def get_with_namespace(cls, id):
+        return cls.get_with_namespace_async(id).get_result()
+
+    @classmethod
+    def get_by_name_with_namespace_async(cls, name):
+        return cls.get_with_namespace_async(name)
+
     @classmethod
     def get_by_name_with_namespace(cls, name):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            qry = Collocation.query(Collocation.name == name)
-            coll = qry.get()
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
-        return coll
+        return cls.get_by_name_with_namespace_async(name).get_result()
+
+    @classmethod
+    def get_multi_by_name_with_namespace_async(cls, names):
+        with namespace_context():
+            return ndb.get_multi_async([ndb.Key(Collocation, name) for name in names])
+
+    @classmethod
+    def get_multi_by_name_with_namespace(cls, names):
+        return [future.get_result()
+                for future in cls.get_multi_by_name_with_namespace_async(names)]
 
     @classmethod
     def get_by_name_or_new_with_namespace(cls, name):
-        coll = cls.get_by_name_with_namespace(name)
-        if coll is None:
-            coll = Collocation()
-            coll.name = name
-            coll.content = ''
-        return coll
+        return cls.get_multi_by_name_or_new_with_namespace([name])[0]
+
+    @classmethod
+    def get_multi_by_name_or_new_with_namespace(cls, names):
+        colls = cls.get_multi_by_name_with_namespace(names)
+        return [coll if coll is not None else cls.new(name) for name, coll in zip(names, colls)]
+
+    @classmethod
+    def put_with_namespace_async(cls, coll):
+        with namespace_context():
+            return coll.put_async()
 
     @classmethod
     def put_with_namespace(cls, coll):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            coll.put()
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
+        return cls.put_with_namespace_async(coll).get_result()
+
+    @classmethod
+    def put_multi_with_namespace_async(cls, colls):
+        with namespace_context():
+            return ndb.put_multi_async(colls)
 
     @classmethod
     def put_multi_with_namespace(cls, colls):
-        user = users.get_current_user()
-        previous_namespace = namespace_manager.get_namespace()
-        try:
-            namespace_manager.set_namespace(user.email().translate(NAMESPACE_TRANS))
-            ndb.put_multi(colls)
-        finally:
-            namespace_manager.set_namespace(previous_namespace)
+        return [future.get_result() for future in cls.put_multi_with_namespace_async(colls)]
+
+    @classmethod
+    def delete_multi_with_namespace_async(cls, colls):
+        return ndb.delete_multi_async([coll.key for coll in colls])
+
+    @classmethod
+    def delete_multi_with_namespace(cls, colls):
+        for future in cls.delete_multi_with_namespace_async(colls):
+            future.get_result()
+
+    @classmethod
+    def delete_numeric_ids_with_namespace(cls, cursor=None):
+        """Deletes a page of collocations stored under numeric ids.
+
+        They are recreated by name on the next collocation update.
+        Returns the number of deleted collocations and the cursor of the
+        next page, or None after the last one.
+        """
+        with namespace_context():
+            qry = Collocation.query()
+        keys, cursor, more = qry.fetch_page(BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        keys = [key for key in keys if key.integer_id() is not None]
+        ndb.delete_multi(keys)
+        return len(keys), cursor if more else None
+
+
+class CollocationRebuild(ndb.Model):
+    """A model for tracking the progress of a collocation rebuild."""
+    status = ndb.StringProperty(indexed=False)
+    fanout_done = ndb.BooleanProperty(default=False, indexed=False)
+    num_documents = ndb.IntegerProperty(default=0, indexed=False)
+    num_shards = ndb.IntegerProperty(default=0, indexed=False)
+    num_partitions = ndb.IntegerProperty(indexed=False)
+    num_collocations = ndb.IntegerProperty(default=0, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def get_with_namespace(cls, id):
+        with namespace_context():
+            return CollocationRebuild.get_by_id(id)
+
+
+class KeyMigration(ndb.Model):
+    """A model for tracking the progress of a key migration.
+
+    stage is the stage being run, or 'done', and page the number of
+    pages of it already done, so a retried task does not count twice.
+    """
+    stage = ndb.StringProperty(indexed=False)
+    page = ndb.IntegerProperty(default=0, indexed=False)
+    num_words = ndb.IntegerProperty(default=0, indexed=False)
+    num_indexed = ndb.IntegerProperty(default=0, indexed=False)
+    num_collocations = ndb.IntegerProperty(default=0, indexed=False)
+    started = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def get_with_namespace(cls, id):
+        with namespace_context():
+            return KeyMigration.get_by_id(id)
+
+
+class DocumentCollocations(ndb.Model):
+    """A model for the collocations a document contributes.
+
+    It shares its id with the document. digests maps each word to a
+    digest of its collocations at revision, so an update rewrites only
+    the words whose collocations changed.
+    """
+    revision = ndb.IntegerProperty(indexed=False)
+    digests = ndb.JsonProperty(compressed=True)
+
+    @classmethod
+    def get_with_namespace(cls, id):
+        with namespace_context():
+            return DocumentCollocations.get_by_id(id)
+
+    @classmethod
+    def put_multi_with_namespace(cls, states):
+        with namespace_context():
+            return ndb.put_multi(states)
+
+    @classmethod
+    def delete_with_namespace(cls, id):
+        with namespace_context():
+            ndb.Key(DocumentCollocations, id).delete()
+
+
+class DocumentStats(ndb.Model):
+    """A model for the vocabulary statistics of a document.
+
+    It shares its id with the document. counter maps the forms of the
+    document to their number of occurrences, so the counts can be
+    recomputed when the lexicon changes without processing the text.
+    """
+    revision = ndb.IntegerProperty(indexed=False)
+    lexicon_version = ndb.IntegerProperty(indexed=False)
+    counter = ndb.JsonProperty(compressed=True)
+    count_words = ndb.IntegerProperty(default=0, indexed=False)
+    count_known_words = ndb.IntegerProperty(default=0, indexed=False)
+    count_unknown_words = ndb.IntegerProperty(default=0, indexed=False)
+    count_new_words = ndb.IntegerProperty(default=0, indexed=False)
+
+    def ratio(self, count):
+        return float(count) / self.count_words if self.count_words else 0.0
+
+    known_ratio = ndb.ComputedProperty(lambda self: self.ratio(self.count_known_words),
+                                      indexed=False)
+    unknown_ratio = ndb.ComputedProperty(lambda self: self.ratio(self.count_unknown_words),
+                                        indexed=False)
+    new_ratio = ndb.ComputedProperty(lambda self: self.ratio(self.count_new_words),
+                                    indexed=False)
+
+    def count(self, forms):
+        """Recomputes the counts from counter against the lexicon forms."""
+        self.count_words = self.count_known_words = 0
+        self.count_unknown_words = self.count_new_words = 0
+        for form, count in self.counter.iteritems():
+            self.count_words += count
+            entry = lemmatize.lookup(forms, form)
+            if entry is None:
+                self.count_new_words += count
+            elif entry[1]:
+                self.count_known_words += count
+            else:
+                self.count_unknown_words += count
+
+    @classmethod
+    def get_multi_with_namespace_async(cls, ids):
+        with namespace_context():
+            return ndb.get_multi_async([ndb.Key(DocumentStats, id) for id in ids])
+
+    @classmethod
+    def get_multi_with_namespace(cls, ids):
+        return [future.get_result() for future in cls.get_multi_with_namespace_async(ids)]
+
+    @classmethod
+    def get_all_with_namespace(cls):
+        with namespace_context():
+            return DocumentStats.query().fetch()
+
+    @classmethod
+    def put_multi_with_namespace(cls, stats):
+        with namespace_context():
+            return ndb.put_multi(stats)
+
+
+class StatsState(ndb.Model):
+    """A model for the task lease and recount progress of a namespace.
+
+    A stats task holds the lease while it updates the statistics, so
+    the tasks of a namespace run one at a time. version is the lexicon
+    version the last recount started from.
+    """
+    lease_until = ndb.DateTimeProperty(indexed=False)
+    version = ndb.IntegerProperty(indexed=False)
+
+    @classmethod
+    def key_for(cls):
+        return ndb.Key(StatsState, LEXICON_ID, namespace=user_namespace())
+
+
+class FormIndex(ndb.Model):
+    """A model for the documents containing a form, keyed by the form.
+
+    counts holds the occurrences of the form in each of documents, so
+    setting the count of a document twice is harmless. name and state
+    follow the lexicon: the word of the form and whether it is known,
+    unknown or new.
+    """
+    documents = ndb.IntegerProperty(repeated=True, indexed=False)
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+    name = ndb.StringProperty(indexed=False)
+    state = ndb.StringProperty()
+    frequency = ndb.ComputedProperty(lambda self: sum(self.counts))
+
+    def set_count(self, document_id, count):
+        if document_id in self.documents:
+            i = self.documents.index(document_id)
+            del self.documents[i]
+            del self.counts[i]
+        if count:
+            self.documents.append(document_id)
+            self.counts.append(count)
+
+    def set_state(self, forms):
+        """Updates name and state from the lexicon forms; True if changed."""
+        form = self.key.id()
+        entry = lemmatize.lookup(forms, form)
+        if entry is None:
+            name, state = form, 'new'
+        else:
+            name, state = entry[0], 'known' if entry[1] else 'unknown'
+        if (self.name, self.state) == (name, state):
+            return False
+        self.name = name
+        self.state = state
+        return True
+
+    @classmethod
+    def get_multi_by_form_or_new_with_namespace(cls, forms):
+        with namespace_context():
+            keys = [ndb.Key(FormIndex, form) for form in forms]
+        indexes = ndb.get_multi(keys)
+        return [index if index is not None else FormIndex(key=key)
+                for key, index in zip(keys, indexes)]
+
+    @classmethod
+    def get_multi_by_form_with_namespace(cls, forms):
+        with namespace_context():
+            return ndb.get_multi([ndb.Key(FormIndex, form) for form in forms])
+
+    @classmethod
+    def fetch_frequent_with_namespace(cls, state, limit):
+        """Returns the most frequent forms in a state across all documents."""
+        with namespace_context():
+            qry = FormIndex.query(FormIndex.state == state).order(-FormIndex.frequency)
+            return qry.fetch(limit)
+
+    @classmethod
+    def iter_all_with_namespace(cls):
+        with namespace_context():
+            return FormIndex.query().iter()
+
+
+class CollocationShard(ndb.Model):
+    """Collocations of a batch of documents for one merge partition.
+
+    collocations maps a word to [document id, collocations] pairs. A
+    partition too large for one entity is split into several parts.
+    """
+    collocations = ndb.JsonProperty(compressed=True)
+
+
+class CollocationMarker(ndb.Model):
+    """Records that a shard or merge task of a collocation rebuild is done.
+
+    Each is a root entity, so tasks finishing together do not contend on
+    the rebuild. count is the number of documents read by a shard or of
+    collocations written by a merge; parts is the number of
+    CollocationShard parts a shard wrote for each partition.
+    """
+    rebuild = ndb.KeyProperty()
+    stage = ndb.StringProperty()
+    count = ndb.IntegerProperty(default=0, indexed=False)
+    parts = ndb.IntegerProperty(repeated=True, indexed=False)
+
+
+class Lexicon(ndb.Model):
+    """A model for representing the version of a user's vocabulary.
+
+    The mapping of surface forms to (lemma, known) is cached in memcache,
+    so it is built from the words only once. A FormTable blob is stored
+    in parts under the version it was built for, and the entry of each
+    later version lists the word changes to apply to it, so saving a
+    word does not serialize the whole table again.
+    """
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # changes before base_version are no longer recorded in changes
+    base_version = ndb.IntegerProperty(default=0, indexed=False)
+    changes = ndb.JsonProperty(compressed=True)
+    count_known = ndb.IntegerProperty(indexed=False)
+    count_unknown = ndb.IntegerProperty(indexed=False)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    def changes_since(self, version):
+        """Returns the forms changed after version, or None if unknown."""
+        if version < self.base_version:
+            return None
+        return set(form for form, changed in (self.changes or {}).iteritems()
+                   if changed > version)
+
+    def changed_since(self, version, forms):
+        if version == self.version:
+            return False
+        changed = self.changes_since(version)
+        return changed is None or not changed.isdisjoint(forms)
+
+    def record_changes(self, forms):
+        changes = self.changes or {}
+        for form in forms:
+            changes[form] = self.version
+        if len(changes) > MAX_LEXICON_CHANGES:
+            versions = sorted(changes.itervalues(), reverse=True)
+            self.base_version = versions[MAX_LEXICON_CHANGES // 2]
+            changes = dict((form, changed) for form, changed in changes.iteritems()
+                           if changed > self.base_version)
+        self.changes = changes
+
+    @staticmethod
+    def changed_forms(changes):
+        forms = set()
+        for old_forms, new_forms in changes:
+            for form in set(old_forms) | set(new_forms):
+                if old_forms.get(form) != new_forms.get(form):
+                    forms.add(form)
+        return forms
+
+    @staticmethod
+    def word_state(word):
+        """Returns whether a stored word is known, or None if not stored.
+
+        Words without a known flag count as unknown, as on /words.
+        """
+        if word.date is None:
+            return None
+        return bool(word.known)
+
+    @staticmethod
+    def count_changes(states):
+        """Returns the changes in the numbers of known and unknown words.
+
+        states is a list of (old, new) pairs of word_state values.
+        """
+        known = unknown = 0
+        for old, new in states:
+            for state, sign in ((old, -1), (new, 1)):
+                if state is True:
+                    known += sign
+                elif state is False:
+                    unknown += sign
+        return known, unknown
+
+    @staticmethod
+    def word_forms(word):
+        if word.known is None:
+            return {}
+        forms = {word.name: [word.name, word.known]}
+        if word.conjugative is not None:
+            for conj in word.conjugative:
+                forms[conj] = [word.name, word.known]
+        return forms
+
+    @staticmethod
+    def apply_changes(forms, changes):
+        for old_forms, new_forms in changes:
+            for form, (lemma, known) in old_forms.iteritems():
+                if form in forms and forms[form][0] == lemma:
+                    del forms[form]
+            for form, (lemma, known) in new_forms.iteritems():
+                # known words take precedence over unknown ones
+                if form not in forms or known or not forms[form][1]:
+                    forms[form] = [lemma, known]
+        return forms
+
+    @staticmethod
+    def cache_key(version):
+        return 'forms:%d' % version
+
+    @staticmethod
+    def part_key(version, part):
+        return 'forms:%d:%d' % (version, part)
+
+    @classmethod
+    def cache_forms(cls, namespace, version, forms):
+        """Caches forms as the table of version, with no changes."""
+        data = forms.dumps()
+        parts = dict((cls.part_key(version, i), data[offset:offset + FORMS_PART_SIZE])
+                     for i, offset in enumerate(range(0, len(data), FORMS_PART_SIZE)))
+        # the entry is set last, so it never refers to missing parts
+        if not memcache.set_multi(parts, time=LEXICON_CACHE_TIME, namespace=namespace):
+            entry = {'base': version, 'parts': len(parts), 'changes': []}
+            memcache.set(cls.cache_key(version), entry, time=LEXICON_CACHE_TIME,
+                         namespace=namespace)
+
+    @classmethod
+    def load_forms(cls, namespace, entry):
+        """Returns the forms of a cache entry, or None if a part was evicted."""
+        keys = [cls.part_key(entry['base'], i) for i in range(entry['parts'])]
+        parts = memcache.get_multi(keys, namespace=namespace)
+        if len(parts) < len(keys):
+            return None
+        forms = FormTable.loads(''.join(parts[key] for key in keys))
+        return cls.apply_changes(forms, entry['changes'])
+
+    @classmethod
+    @ndb.tasklet
+    def get_with_namespace_async(cls):
+        key = ndb.Key(Lexicon, LEXICON_ID, namespace=user_namespace())
+        lexicon = yield key.get_async()
+        if lexicon is None:
+            lexicon = Lexicon(key=key)
+        raise ndb.Return(lexicon)
+
+    @classmethod
+    def get_with_namespace(cls):
+        return cls.get_with_namespace_async().get_result()
+
+    @classmethod
+    def get_counts_with_namespace(cls):
+        lexicon = cls.get_with_namespace()
+        if lexicon.count_known is not None:
+            return lexicon.count_known, lexicon.count_unknown
+
+        # counted once; kept up to date by update_with_namespace
+        namespace = user_namespace()
+        updated = lexicon.updated
+        known = Word.query(Word.known == True, namespace=namespace).count()
+        unknown = Word.query(namespace=namespace).count() - known
+        # the queries may miss words saved just before; stored once they cannot
+        if (lexicon.updated is not None and
+                datetime.utcnow() - lexicon.updated <= timedelta(seconds=QUERY_CONSISTENCY_DELAY)):
+            return known, unknown
+
+        @ndb.transactional
+        def init():
+            lexicon = ndb.Key(Lexicon, LEXICON_ID, namespace=namespace).get()
+            if lexicon is None:
+                lexicon = Lexicon(id=LEXICON_ID, namespace=namespace)
+            if lexicon.count_known is None:
+                if lexicon.updated != updated:
+                    # words were written while counting; counted again later
+                    return known, unknown
+                lexicon.count_known = known
+                lexicon.count_unknown = unknown
+                lexicon.put()
+            return lexicon.count_known, lexicon.count_unknown
+
+        return init()
+
+    @classmethod
+    def get_forms_with_namespace(cls, lexicon=None):
+        namespace = user_namespace()
+        if lexicon is None:
+            lexicon = cls.get_with_namespace()
+        entry = memcache.get(cls.cache_key(lexicon.version), namespace=namespace)
+        if entry is not None:
+            forms = cls.load_forms(namespace, entry)
+            if forms is not None:
+                return forms
+
+        # words are not kept; apply_changes lets known words take precedence
+        forms = {}
+        for word in Word.query(namespace=namespace).iter(batch_size=BATCH_SIZE):
+            cls.apply_changes(forms, [({}, cls.word_forms(word))])
+        forms = FormTable.from_dict(forms)
+        # the query may miss words saved just before; rebuilt until it cannot
+        if (lexicon.updated is None or
+                datetime.utcnow() - lexicon.updated > timedelta(seconds=QUERY_CONSISTENCY_DELAY)):
+            cls.cache_forms(namespace, lexicon.version, forms)
+        return forms
+
+    @classmethod
+    def add_counts_with_namespace(cls, states):
+        """Applies the changes of states to the counters, if counted."""
+        key = ndb.Key(Lexicon, LEXICON_ID, namespace=user_namespace())
+        known, unknown = cls.count_changes(states)
+        if not known and not unknown:
+            return
+
+        @ndb.transactional
+        def increment():
+            lexicon = key.get() or Lexicon(key=key)
+            if lexicon.count_known is not None:
+                lexicon.count_known += known
+                lexicon.count_unknown += unknown
+            # while not counted, updated tells a counting request of the words
+            lexicon.put()
+
+        increment()
+
+    @classmethod
+    def bump_with_namespace(cls, changed_forms):
+        """Bumps the version after words were written in bulk.
+
+        The forms of the new version are rebuilt from the words rather
+        than patched. Returns the new version.
+        """
+        key = ndb.Key(Lexicon, LEXICON_ID, namespace=user_namespace())
+
+        @ndb.transactional
+        def increment():
+            lexicon = key.get()
+            if lexicon is None:
+                lexicon = Lexicon(key=key)
+            lexicon.version += 1
+            lexicon.record_changes(changed_forms)
+            lexicon.put()
+            return lexicon.version
+
+        return increment()
+
+    @classmethod
+    def update_with_namespace(cls, changes, states=(), put=(), delete=()):
+        """Bumps the version and applies changes to the cached forms.
+
+        changes is a list of (old_forms, new_forms) pairs as returned
+        by word_forms for a word before and after it was modified, and
+        states the matching pairs of word_state values for the counters.
+        The words in put and the keys in delete are written in the same
+        transaction as the counters, so they are at most
+        MAX_TRANSACTION_WORDS.
+        """
+        namespace = user_namespace()
+        key = ndb.Key(Lexicon, LEXICON_ID, namespace=namespace)
+        changed_forms = cls.changed_forms(changes)
+        known, unknown = cls.count_changes(states)
+
+        @ndb.transactional(xg=True)
+        def increment():
+            lexicon = key.get()
+            if lexicon is None:
+                lexicon = Lexicon(key=key)
+            lexicon.version += 1
+            lexicon.record_changes(changed_forms)
+            if lexicon.count_known is not None:
+                lexicon.count_known += known
+                lexicon.count_unknown += unknown
+            ndb.put_multi([lexicon] + list(put))
+            ndb.delete_multi(delete)
+            return lexicon.version
+
+        version = increment()
+        entry = memcache.get(cls.cache_key(version - 1), namespace=namespace)
+        if entry is not None:
+            # a form dropped with a word may still belong to another one
+            owners = cls.form_owners(cls.dropped_forms(changes), namespace,
+                                     cls.changed_lemmas(changes))
+            entry = dict(entry, changes=entry['changes'] + list(changes) +
+                         [({}, owner) for owner in owners])
+            if len(entry['changes']) <= MAX_CACHED_CHANGES:
+                memcache.set(cls.cache_key(version), entry, time=LEXICON_CACHE_TIME,
+                             namespace=namespace)
+            else:
+                forms = cls.load_forms(namespace, entry)
+                if forms is not None:
+                    cls.cache_forms(namespace, version, forms)
+        return version
+
+    @staticmethod
+    def changed_lemmas(changes):
+        return set(lemma for old_forms, new_forms in changes
+                   for lemma, known in old_forms.values() + new_forms.values())
+
+    @staticmethod
+    def dropped_forms(changes):
+        """Returns the forms a change takes away from their lemma."""
+        forms = set()
+        for old_forms, new_forms in changes:
+            for form, (lemma, known) in old_forms.iteritems():
+                if form not in new_forms or new_forms[form][0] != lemma:
+                    forms.add(form)
+        return forms
+
+    @classmethod
+    def form_owners(cls, forms, namespace, exclude):
+        """Returns word_forms of the words named or conjugated as any of forms.
+
+        Words named in exclude are left out; the query is eventually
+        consistent and may still return them as they were.
+        """
+        forms = sorted(forms)
+        if not forms:
+            return []
+        words = ndb.get_multi([ndb.Key(Word, form, namespace=namespace) for form in forms])
+        for i in range(0, len(forms), MAX_IN_VALUES):
+            qry = Word.query(Word.conjugative.IN(forms[i:i + MAX_IN_VALUES]), namespace=namespace)
+            words += qry.fetch()
+        return [cls.word_forms(word) for word in words
+                if word is not None and word.name not in exclude]
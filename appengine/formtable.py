@@ -0,0 +1,98 @@
+# coding:utf-8
+
+import struct
+import sys
+import zlib
+from array import array
+from itertools import izip
+
+KNOWN = 1
+HEADER = struct.Struct('<II')
+SEPARATOR = u'\x00'
+
+
+class FormTable(object):
+    """A compact mapping of surface forms to (lemma, known).
+
+    Each form maps to an int packing the index of its lemma in lemmas
+    with its known bit, so lemmas are stored once and a lookup is a
+    single dict probe. It serializes to one blob: the packed values as
+    an array followed by the lemmas and forms as NUL separated text.
+    Items can be set and deleted as in the dict, so cached changes can
+    be applied to a loaded table.
+    """
+    __slots__ = ('index', 'lemmas', 'lemma_ids')
+
+    def __init__(self, index=None, lemmas=None):
+        self.index = index if index is not None else {}
+        self.lemmas = lemmas if lemmas is not None else []
+        self.lemma_ids = None
+
+    def get(self, form, default=None):
+        value = self.index.get(form)
+        if value is None:
+            return default
+        return self.lemmas[value >> 1], bool(value & KNOWN)
+
+    def __getitem__(self, form):
+        value = self.index[form]
+        return self.lemmas[value >> 1], bool(value & KNOWN)
+
+    def __setitem__(self, form, value):
+        lemma, known = value
+        if self.lemma_ids is None:
+            # built on the first change; lemmas dropped later stay unused
+            self.lemma_ids = dict((lemma, i) for i, lemma in enumerate(self.lemmas))
+        lemma_id = self.lemma_ids.get(lemma)
+        if lemma_id is None:
+            lemma_id = self.lemma_ids[lemma] = len(self.lemmas)
+            self.lemmas.append(lemma)
+        self.index[form] = lemma_id << 1 | (KNOWN if known else 0)
+
+    def __delitem__(self, form):
+        del self.index[form]
+
+    def __contains__(self, form):
+        return form in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    @staticmethod
+    def from_dict(forms):
+        """Builds a table from a dict of forms to (lemma, known)."""
+        lemma_ids = {}
+        lemmas = []
+        index = {}
+        for form, (lemma, known) in forms.iteritems():
+            lemma_id = lemma_ids.get(lemma)
+            if lemma_id is None:
+                lemma_id = lemma_ids[lemma] = len(lemmas)
+                lemmas.append(lemma)
+            index[form] = lemma_id << 1 | (KNOWN if known else 0)
+        return FormTable(index, lemmas)
+
+    def to_dict(self):
+        lemmas = self.lemmas
+        return dict((form, [lemmas[value >> 1], bool(value & KNOWN)])
+                    for form, value in self.index.iteritems())
+
+    def dumps(self):
+        forms = sorted(self.index, key=self.index.get)
+        values = array('I', [self.index[form] for form in forms])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        text = SEPARATOR.join(self.lemmas + forms).encode('utf-8')
+        return zlib.compress(HEADER.pack(len(self.lemmas), len(forms)) + values.tostring() + text)
+
+    @staticmethod
+    def loads(data):
+        data = zlib.decompress(data)
+        num_lemmas, num_forms = HEADER.unpack_from(data)
+        offset = HEADER.size + array('I').itemsize * num_forms
+        values = array('I')
+        values.fromstring(data[HEADER.size:offset])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        strings = data[offset:].decode('utf-8').split(SEPARATOR) if num_lemmas else []
+        return FormTable(dict(izip(strings[num_lemmas:], values)), strings[:num_lemmas])
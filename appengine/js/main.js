@@ -1,6 +1,159 @@
+var lexiconVersion = null;
+var wordLinks = {};
+var wordStates = {};
+var loadingSection = false;
+// word modal bodies by url, most recently opened last
+var wordModalCache = {};
+var wordModalUrls = [];
+var WORD_MODAL_CACHE_SIZE = 50;
+var SEARCH_DELAY = 150;
+var searchTimer = null;
+
+function applyState(links, form) {
+    var entry = wordStates[form];
+    links.removeClass('known unknown new');
+    if (entry === undefined || entry === null) {
+        links.addClass('new').attr('href', '/word?name=' + encodeURIComponent(form));
+    } else {
+        links.addClass(entry[1] ? 'known' : 'unknown')
+            .attr('href', '/word?name=' + encodeURIComponent(entry[0]));
+    }
+}
+
+function indexWords(container) {
+    container.find('a[data-form]').each(function () {
+        var form = this.getAttribute('data-form');
+        (wordLinks[form] = wordLinks[form] || []).push(this);
+        applyState($(this), form);
+    });
+}
+
+function updateWords() {
+    var doc = $('#document[data-words]');
+    if (doc.length == 0) {
+        return;
+    }
+    var data = lexiconVersion === null ? {} : {since: lexiconVersion};
+    $.getJSON(doc.data('words'), data, function (payload) {
+        lexiconVersion = payload.version;
+        if (payload.reset) {
+            wordStates = payload.words;
+            $.each(wordLinks, function (form, links) {
+                applyState($(links), form);
+            });
+            return;
+        }
+        $.each(payload.words, function (form, entry) {
+            wordStates[form] = entry;
+            applyState($(wordLinks[form] || []), form);
+        });
+    });
+}
+
+function loadSections() {
+    var sections = $('#sections');
+    if (sections.length == 0 || loadingSection) {
+        return;
+    }
+    var next = sections.children('.section').length;
+    if (next >= sections.data('count')) {
+        return;
+    }
+    if ($(window).scrollTop() + 2 * $(window).height() < sections.offset().top + sections.height()) {
+        return;
+    }
+    loadingSection = true;
+    $.get(sections.data('url') + next, {render: sections.data('render')}, function (html) {
+        var section = $(html).appendTo(sections);
+        indexWords(section);
+        loadingSection = false;
+        loadSections();
+    }).fail(function () {
+        loadingSection = false;
+    });
+}
+
+$(function () {
+    indexWords($('#document[data-words]'));
+    updateWords();
+    loadSections();
+    $(window).on('scroll', loadSections);
+});
+
+function cacheWordModal(url, html) {
+    var i = wordModalUrls.indexOf(url);
+    if (i >= 0) {
+        wordModalUrls.splice(i, 1);
+    }
+    wordModalUrls.push(url);
+    wordModalCache[url] = html;
+    while (wordModalUrls.length > WORD_MODAL_CACHE_SIZE) {
+        delete wordModalCache[wordModalUrls.shift()];
+    }
+}
+
+function clearWordModalCache() {
+    wordModalCache = {};
+    wordModalUrls = [];
+}
+
+function loadWordModal(url) {
+    var body = $('#wordModalBody').data('url', url);
+    if (wordModalCache.hasOwnProperty(url)) {
+        body.html(wordModalCache[url]);
+        cacheWordModal(url, wordModalCache[url]);
+        return;
+    }
+    body.empty();
+    $.get(url, function (html) {
+        cacheWordModal(url, html);
+        // another word may have been opened meanwhile
+        if (body.data('url') == url) {
+            body.html(html);
+        }
+    });
+}
+
+function searchWords(input) {
+    var query = $.trim(input.val());
+    var list = $('#wordSuggestions');
+    if (query == '') {
+        list.empty();
+        return;
+    }
+    $.getJSON('/words/search', {q: query}, function (payload) {
+        // typed on meanwhile
+        if ($.trim(input.val()) != query) {
+            return;
+        }
+        list.empty();
+        $.each(payload.words, function (i, word) {
+            $('<option>').attr('value', word.name).appendTo(list);
+        });
+    });
+}
+
 $('#wordModal').on('show.bs.modal', function (e) {
-    var link = $(e.relatedTarget);
-    $('#wordModalBody').load(link.attr('href'));
+    loadWordModal($(e.relatedTarget).attr('href'));
+});
+
+$('#wordModalBody').on('input', 'input[name=name]', function () {
+    var input = $(this);
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(function () {
+        searchWords(input);
+    }, SEARCH_DELAY);
+});
+
+// a suggestion was picked, open that word instead
+$('#wordModalBody').on('change', 'input[name=name]', function () {
+    var name = $(this).val();
+    var picked = $('#wordSuggestions option').filter(function () {
+        return this.value == name;
+    });
+    if (picked.length > 0) {
+        loadWordModal('/word?name=' + encodeURIComponent(name));
+    }
 });
 
 $('#saveWord').on('click', function (e) {
@@ -11,7 +164,9 @@ $('#saveWord').on('click', function (e) {
         type: form.attr('method'),
         data: form.serialize(),
         success: function () {
+            clearWordModalCache();
             $('#wordModal').modal('hide');
+            updateWords();
         },
     });
 });
@@ -24,7 +179,9 @@ $('#deleteWord').on('click', function (e) {
         type: form.attr('method'),
         data: form.serialize(),
         success: function () {
+            clearWordModalCache();
             $('#wordModal').modal('hide');
+            updateWords();
         },
     });
 });
@@ -0,0 +1,192 @@
+# coding:utf-8
+
+import os
+
+# falls back on the lemmas of forms missing from the lexicon; off until
+# the rules are tuned on real documents, set in app.yaml
+ENABLED = os.environ.get('LEMMATIZE', '0') == '1'
+
+# (suffix, replacement) pairs turning an inflected form into a candidate
+# lemma, most likely first; "walked" -> "walk", "tried" -> "try"
+RULES = [
+    ('ies', 'y'),
+    ('es', ''),
+    ('s', ''),
+    ('ied', 'y'),
+    ('ed', ''),
+    ('ed', 'e'),
+    ('ing', ''),
+    ('ing', 'e'),
+    ('ier', 'y'),
+    ('iest', 'y'),
+    ('er', ''),
+    ('er', 'e'),
+    ('est', ''),
+    ('est', 'e'),
+]
+# suffixes doubling a final consonant, as in "stopped" or "running";
+# "bigger" and the like are listed in IRREGULAR, doubling before "er"
+# turns "manner" into "man"
+DOUBLING_SUFFIXES = ('ed', 'ing')
+VOWELS = frozenset('aeiouy')
+SUFFIX_ENDINGS = frozenset(suffix[-1] for suffix, _ in RULES)
+# letters left after stripping a suffix, so "best" is not "be"
+MIN_STEM_LEN = 3
+MIN_LEMMA_LEN = 3
+CACHE_SIZE = 10000
+
+# forms the rules get wrong, mapped to their lemma
+IRREGULAR = {
+    'am': 'be', 'is': 'be', 'are': 'be', 'was': 'be', 'were': 'be', 'been': 'be',
+    'has': 'have', 'had': 'have',
+    'does': 'do', 'did': 'do', 'done': 'do',
+    'goes': 'go', 'went': 'go', 'gone': 'go',
+    'used': 'use', 'died': 'die', 'dying': 'die', 'lied': 'lie', 'lying': 'lie',
+    'tied': 'tie', 'tying': 'tie',
+    'tried': 'try', 'tries': 'try', 'cried': 'cry', 'cries': 'cry', 'dried': 'dry',
+    'dries': 'dry', 'fried': 'fry', 'fries': 'fry', 'flies': 'fly', 'skies': 'sky',
+    'made': 'make', 'said': 'say', 'took': 'take', 'taken': 'take', 'came': 'come',
+    'saw': 'see', 'seen': 'see', 'got': 'get', 'gotten': 'get', 'gave': 'give',
+    'given': 'give', 'knew': 'know', 'known': 'know', 'thought': 'think', 'told': 'tell',
+    'found': 'find', 'left': 'leave', 'felt': 'feel', 'brought': 'bring', 'bought': 'buy',
+    'kept': 'keep', 'began': 'begin', 'begun': 'begin', 'ran': 'run', 'wrote': 'write',
+    'written': 'write', 'spoke': 'speak', 'spoken': 'speak', 'ate': 'eat', 'eaten': 'eat',
+    'children': 'child', 'men': 'man', 'women': 'woman', 'feet': 'foot', 'teeth': 'tooth',
+    'mice': 'mouse',
+    'better': 'good', 'best': 'good', 'worse': 'bad', 'worst': 'bad',
+    'bigger': 'big', 'biggest': 'big', 'hotter': 'hot', 'hottest': 'hot',
+    'fatter': 'fat', 'fattest': 'fat', 'thinner': 'thin', 'thinnest': 'thin',
+    'wetter': 'wet', 'wettest': 'wet', 'sadder': 'sad', 'saddest': 'sad',
+    'redder': 'red', 'reddest': 'red',
+}
+# forms ending like an inflection whose stripped stem is another word
+NOT_INFLECTED = frozenset([
+    'news', 'series', 'species', 'always', 'perhaps', 'hers', 'ours', 'yours', 'less',
+    'unless', 'during', 'nothing', 'something', 'anything', 'everything', 'morning',
+    'evening', 'ceiling', 'king', 'ring', 'sing', 'thing', 'bring', 'spring', 'string',
+    'wing', 'swing', 'wicked', 'forest', 'honest', 'interest', 'corner', 'offer', 'after',
+    'other', 'mother', 'brother', 'father', 'number', 'flower', 'tower', 'shower', 'power',
+    'never', 'ever', 'over', 'under', 'order', 'water', 'paper', 'matter', 'letter',
+    'winter', 'summer', 'either', 'whether', 'rather', 'together', 'weather',
+])
+_INFLECTED_IRREGULAR = {}
+for _form, _lemma in IRREGULAR.iteritems():
+    _INFLECTED_IRREGULAR.setdefault(_lemma, set()).add(_form)
+
+
+class BoundedCache(object):
+    """A cache keeping about the maxsize most recently used entries.
+
+    It approximates LRU with two generations of plain dicts: hits in the
+    old generation move to the new one, and the old generation is dropped
+    when the new one is full. On Python 2.7 OrderedDict is written in
+    Python, and moving an entry costs as much as computing candidates.
+    Races between requests only lose cached entries.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.new = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.new[key]
+        except KeyError:
+            try:
+                value = self.old[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.put(key, value)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if len(self.new) >= self.maxsize // 2:
+            self.old = self.new
+            self.new = {}
+        self.new[key] = value
+
+    def __len__(self):
+        return len(self.new) + len(self.old)
+
+
+_cache = BoundedCache(CACHE_SIZE)
+
+
+def _candidates(form):
+    if form in IRREGULAR:
+        return (IRREGULAR[form],)
+    if form[-1:] not in SUFFIX_ENDINGS or form in NOT_INFLECTED:
+        return ()
+    found = []
+    for suffix, replacement in RULES:
+        if not form.endswith(suffix):
+            continue
+        stem = form[:-len(suffix)]
+        if len(stem) < MIN_STEM_LEN or len(stem) + len(replacement) < MIN_LEMMA_LEN:
+            continue
+        lemma = stem + replacement
+        if lemma not in found:
+            found.append(lemma)
+        if (replacement == '' and suffix in DOUBLING_SUFFIXES and len(stem) > MIN_STEM_LEN and
+                stem[-1] == stem[-2] and stem[-1] not in VOWELS and stem[:-1] not in found):
+            found.append(stem[:-1])
+    return tuple(found)
+
+
+def candidates(form):
+    """Returns the possible lemmas of a lowercase form, memoized."""
+    result = _cache.get(form)
+    if result is None:
+        result = _candidates(form)
+        _cache.put(form, result)
+    return result
+
+
+def inflections(lemma):
+    """Returns every form whose candidates may include lemma."""
+    forms = set(_INFLECTED_IRREGULAR.get(lemma, ()))
+    for suffix, replacement in RULES:
+        if lemma.endswith(replacement):
+            forms.add(lemma[:len(lemma) - len(replacement)] + suffix)
+            if replacement == '' and suffix in DOUBLING_SUFFIXES:
+                forms.add(lemma + lemma[-1:] + suffix)
+    return forms
+
+
+def lookup(forms, form):
+    """Returns the lexicon entry of a form, falling back on its lemmas."""
+    entry = forms.get(form)
+    if entry is None and ENABLED:
+        for lemma in candidates(form):
+            entry = forms.get(lemma)
+            if entry is not None:
+                break
+    return entry
+
+
+def dependent_forms(forms, words):
+    """Returns words with the lemmas their lookup depends on.
+
+    A word found in forms does not depend on its lemmas; any other word
+    changes state when one of its candidate lemmas is added.
+    """
+    result = set(words)
+    if not ENABLED:
+        return result
+    for word in words:
+        if word not in forms:
+            result.update(candidates(word))
+    return result
+
+
+def affected_forms(words, changed):
+    """Returns the words whose lookup may differ after changed forms."""
+    if not ENABLED:
+        return set(words) & changed
+    return set(word for word in words
+               if word in changed or not changed.isdisjoint(candidates(word)))
@@ -16,48 +16,339 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import defaultdict
-import csv
-from datetime import datetime
+import gzip
+import hashlib
+import itertools
 import json
+import logging
 import os
-import re
 import StringIO
+import urllib
+import zlib
 
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.api import users
+from google.appengine.ext import ndb
 import jinja2
 import webapp2
 
-from process import Processor
-from db import Document, Word, Collocation
+import collocation
+import lemmatize
+import migrate
+import profiling
+import stats
+from process import Processor, split_sections
+from db import Document, DocumentStats, RenderedDocument, RenderedSection, Word
+from db import Collocation, CollocationRebuild, KeyMigration, Lexicon, namespace_context
+from db import user_namespace
+
+# render documents without word states and let main.js apply them
+CLIENT_RENDERING = False
+
+WORDS_PAGE_SIZE = 100
+FREQUENT_WORDS_LIMIT = 100
+MAX_FREQUENT_WORDS_LIMIT = 1000
+SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 100
+BACKUP_BATCH_SIZE = 500
+RESTORE_BATCH_SIZE = 500
+# payload bytes per task, below the 100KB task limit with the url and headers
+RESTORE_TASK_SIZE = 90 * 1024
+RESTORE_TASKS_PER_ADD = 10
+# uploads larger than this are restored in tasks unless ?defer=0
+RESTORE_INLINE_SIZE = 256 * 1024
+# the body of a restore task is the backup chunk itself
+NAMESPACE_HEADER = 'X-Restore-Namespace'
+STREAM_CHUNK_SIZE = 64 * 1024
+
+DEVELOPMENT = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
+TEMPLATE_CACHE_PREFIX = 'jinja2:'
+
+
+class TemplateCacheClient(object):
+    """Memcache for the template bytecode, shared by all users.
+
+    Templates are otherwise compiled from source once per instance.
+    """
+
+    def get(self, key):
+        return memcache.get(key, namespace='')
+
+    def set(self, key, value, timeout=0):
+        memcache.set(key, value, time=timeout, namespace='')
+
 
 JINJA_ENVIRONMENT = jinja2.Environment(
     loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
     extensions=['jinja2.ext.autoescape'],
-    autoescape=True)
+    autoescape=True,
+    # deployed templates never change, so skip checking their mtime
+    auto_reload=DEVELOPMENT,
+    bytecode_cache=jinja2.MemcachedBytecodeCache(TemplateCacheClient(), TEMPLATE_CACHE_PREFIX))
+# added to jinja2 in 2.7, the runtime provides 2.6
+JINJA_ENVIRONMENT.filters.setdefault(
+    'urlencode', lambda value: urllib.quote(unicode(value).encode('utf-8'), safe=''))
+
+
+def tee(iterable, out):
+    """Yields the items of iterable, appending them to out."""
+    for item in iterable:
+        out.append(item)
+        yield item
+
+
+def write_chunks(response, iterable, size=STREAM_CHUNK_SIZE):
+    """Writes the strings of iterable to the response in chunks of size."""
+    chunk = []
+    length = 0
+    for s in iterable:
+        chunk.append(s)
+        length += len(s)
+        if length >= size:
+            response.write(''.join(chunk))
+            chunk = []
+            length = 0
+    if chunk:
+        response.write(''.join(chunk))
+
+
+def etag(*parts):
+    """Returns a strong entity tag for a response determined by parts.
+
+    The application version and the user are part of every tag, so
+    a deployment or another account on the same browser never matches.
+    """
+    parts = (os.environ.get('CURRENT_VERSION_ID'), user_namespace()) + parts
+    data = ':'.join(unicode(part).encode('utf-8') for part in parts)
+    return hashlib.sha1(data).hexdigest()[:20]
+
+
+def rendered_sections(document):
+    """Returns the number of sections of a document that may have renders."""
+    rendered = RenderedDocument.get_with_namespace(document.key.id())
+    # the last render may be of a longer revision
+    previous = rendered.num_sections if rendered is not None else None
+    return max(previous or 0, len(split_sections(document.content)))
+
+
+def not_modified(handler, *parts):
+    """Tags the response and answers 304 if the client has it already."""
+    tag = etag(*parts)
+    handler.response.headers['ETag'] = '"%s"' % tag
+    # per user and revalidated on every use
+    handler.response.headers['Cache-Control'] = 'private, no-cache'
+    if tag in handler.request.if_none_match:
+        handler.response.status = 304
+        return True
+    return False
+
+
+def limit_param(handler, default, maximum=None):
+    """Returns the limit parameter clamped to 1..maximum; 400 if not a number."""
+    limit = handler.request.get('limit')
+    if limit == '':
+        return default
+    try:
+        limit = int(limit)
+    except ValueError:
+        handler.abort(400)
+    if maximum is not None:
+        limit = min(limit, maximum)
+    return max(limit, 1)
+
 
 class MainPageHandler(webapp2.RequestHandler):
 
     def get(self):
-        documents = Document.get_all_with_namespace()
+        word_name = self.request.get('word').lower()
+        if word_name:
+            word = Word.get_with_namespace(word_name)
+            forms = set(Lexicon.word_forms(word)) if word is not None else set()
+            ids = stats.documents_containing(forms | {word_name})
+            documents = [document for document in Document.get_multi_with_namespace(sorted(ids))
+                         if document is not None]
+            documents.sort(key=lambda document: document.date, reverse=True)
+        else:
+            documents = Document.get_all_with_namespace()
+        document_stats = DocumentStats.get_multi_with_namespace([d.key.id() for d in documents])
+        # documents saved before statistics were kept
+        stats.backfill_documents([document.key.id() for document, s
+                                  in zip(documents, document_stats) if s is None])
+        sort = self.request.get('sort')
+        try:
+            max_new = float(self.request.get('max_new')) / 100
+        except ValueError:
+            max_new = None
         template_values = {
-            'documents': documents,
+            'documents': stats.sort_documents(documents, document_stats, sort, max_new),
+            'sort': sort,
+            'max_new': self.request.get('max_new') if max_new is not None else '',
+            'word': word_name,
         }
         template = JINJA_ENVIRONMENT.get_template('index.html')
         self.response.write(template.render(template_values))
 
 
-class ShowDocumentHandler(webapp2.RequestHandler):
+class SectionRenderingHandler(webapp2.RequestHandler):
+    """Base of the handlers rendering a document section through its cache."""
+
+    def neutral(self):
+        default_render = 'client' if CLIENT_RENDERING else 'server'
+        return self.request.get('render', default_render) == 'client'
+
+    def not_modified(self, document, rendered, lexicon, neutral, section):
+        """Answers 304 if the section the client has is still current.
+
+        A current cached render stands for every lexicon version since
+        it was made, so unrelated word changes keep the tag.
+        """
+        if neutral:
+            lexicon_version = None
+        elif rendered is not None and rendered.is_current(document, lexicon, neutral):
+            lexicon_version = rendered.lexicon_version
+        else:
+            lexicon_version = lexicon.version
+        return not_modified(self, document.key.id(), section, document.revision, neutral,
+                            lexicon_version)
+
+    def write_section(self, template_name, template_values, document, rendered, lexicon,
+                      section, lines):
+        neutral = template_values['neutral']
+        template = JINJA_ENVIRONMENT.get_template(template_name)
+        if rendered is not None and rendered.is_current(document, lexicon, neutral):
+            template_values['title'] = rendered.title
+            template_values['lines'] = rendered.html_lines()
+            with profiling.phase('render'):
+                write_chunks(self.response, template.generate(template_values))
+            return
+
+        # lines left unchanged by an edit are reused from the previous render
+        cached = {}
+        forms = set()
+        if rendered is not None and rendered.lines and rendered.is_reusable(lexicon, neutral):
+            cached = dict((entry[0], entry) for entry in rendered.lines)
+            forms.update(rendered.forms)
+        with profiling.phase('lexicon'):
+            processor = Processor(lexicon, neutral=neutral)
+        with profiling.phase('process'):
+            title = processor.process_text(document.title) if section == 0 else None
+        # the line entries are kept for the cache as they are streamed
+        entries = []
+        template_values['title'] = title
+        template_values['lines'] = (entry[1] for entry in profiling.timed_iter(
+            'process', tee(processor.iter_line_entries(lines, cached), entries)))
+        with profiling.phase('render'):
+            write_chunks(self.response, template.generate(template_values))
+        forms.update(processor.dependent_forms())
+        key = RenderedDocument.key_for(document.key.id(), section)
+        model = RenderedDocument if section == 0 else RenderedSection
+        rendered = model(id=key.id(),
+                         namespace=document.key.namespace(),
+                         revision=document.revision,
+                         lexicon_version=lexicon.version,
+                         neutral=neutral,
+                         title=title,
+                         lines=entries,
+                         forms=list(forms),
+                         count_words=processor.count_words,
+                         count_known_words=processor.count_known_words,
+                         count_unknown_words=processor.count_unknown_words,
+                         count_new_words=processor.count_new_words,
+                         num_sections=template_values.get('num_sections'))
+        with profiling.phase('cache'):
+            RenderedDocument.put_with_namespace(rendered)
+
+
+class ShowDocumentHandler(SectionRenderingHandler):
 
     def get(self, *args):
         id = args[0]
-        document = Document.get_with_namespace(int(id))
-        processor = Processor()
-        processor.process_document(document)
+        with profiling.phase('load'):
+            document, rendered, lexicon = Document.get_with_rendered_with_namespace(int(id))
+        if document is None:
+            self.abort(404)
+        neutral = self.neutral()
+        if self.not_modified(document, rendered, lexicon, neutral, 0):
+            return
+        # only the first section is rendered, main.js loads the others
+        sections = split_sections(document.content)
         template_values = {
             'document': document,
+            'neutral': neutral,
+            'num_sections': len(sections),
         }
-        template = JINJA_ENVIRONMENT.get_template('document_show.html')
-        self.response.write(template.render(template_values))
+        self.write_section('document_show.html', template_values, document, rendered, lexicon,
+                           0, sections[0])
+
+
+class DocumentSectionHandler(SectionRenderingHandler):
+
+    def get(self, *args):
+        id = args[0]
+        section = int(args[1])
+        with profiling.phase('load'):
+            document, rendered, lexicon = Document.get_with_rendered_with_namespace(int(id),
+                                                                                    section)
+        if document is None:
+            self.abort(404)
+        neutral = self.neutral()
+        if self.not_modified(document, rendered, lexicon, neutral, section):
+            return
+        sections = split_sections(document.content)
+        if section >= len(sections):
+            self.abort(404)
+        template_values = {
+            'document': document,
+            'neutral': neutral,
+            'section': section,
+        }
+        self.write_section('document_section.html', template_values, document, rendered, lexicon,
+                           section, sections[section])
+
+
+class DocumentWordsHandler(webapp2.RequestHandler):
+
+    def get(self, *args):
+        id = int(args[0])
+        document_future = Document.get_with_namespace_async(id)
+        stats_future = DocumentStats.get_multi_with_namespace_async([id])[0]
+        lexicon = Lexicon.get_with_namespace()
+        document = document_future.get_result()
+        document_stats = stats_future.get_result()
+        if document is None:
+            self.abort(404)
+        if document_stats is not None and document_stats.revision == document.revision:
+            forms = set(document_stats.counter)
+        else:
+            forms = set(stats.document_counter(document))
+
+        since = self.request.get('since')
+        changed = None
+        if since != '':
+            try:
+                changed = lexicon.changes_since(int(since))
+            except ValueError:
+                self.abort(400)
+        words = {}
+        if changed is None:
+            # full state; forms missing from the lexicon are new
+            lexicon_forms = Lexicon.get_forms_with_namespace(lexicon)
+            for form in forms:
+                entry = lemmatize.lookup(lexicon_forms, form)
+                if entry is not None:
+                    words[form] = entry
+        else:
+            forms = lemmatize.affected_forms(forms, changed)
+            if forms:
+                lexicon_forms = Lexicon.get_forms_with_namespace(lexicon)
+                for form in forms:
+                    words[form] = lemmatize.lookup(lexicon_forms, form)
+
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        # a full state replaces the client's, forms left out of it are new
+        payload = {'version': lexicon.version, 'words': words, 'reset': changed is None}
+        return self.response.write(json.dumps(payload, separators=(',', ':')))
 
 
 class EditDocumentHandler(webapp2.RequestHandler):
@@ -80,9 +371,17 @@ class EditDocumentHandler(webapp2.RequestHandler):
             document = Document.new()
         else:
             document = Document.get_with_namespace(int(id))
+        old_sections = rendered_sections(document) if id != '' else 0
         document.title = self.request.get('title')
         document.content = self.request.get('content')
+        document.revision += 1
         Document.put_with_namespace(document)
+        num_sections = len(split_sections(document.content))
+        if old_sections > num_sections:
+            RenderedDocument.delete_sections_with_namespace(document.key.id(), num_sections,
+                                                            old_sections)
+        collocation.enqueue_document(document)
+        stats.enqueue_documents('update', [document.key.id()])
         self.redirect('/')
 
 
@@ -101,7 +400,9 @@ class DeleteDocumentHandler(webapp2.RequestHandler):
             self.redirect('/')
             return
 
-        document.key.delete()
+        Document.delete_with_namespace(document, rendered_sections(document))
+        collocation.enqueue_document(document)
+        stats.enqueue_documents('remove', [document.key.id()])
         self.redirect('/')
 
 
@@ -112,22 +413,16 @@ class WordHandler(webapp2.RequestHandler):
         if word_name == '':
             self.redirect('/')
             return
-        word = Word.get_by_name_or_new_with_namespace(word_name)
-
-        # collocations
-        colls = []
-        coll = Collocation.get_by_name_with_namespace(word_name)
-        if coll is not None:
-            colls.append(coll.collocation)
-        if word.conjugative is not None:
-            for conj in word.conjugative:
-                coll = Collocation.get_by_name_with_namespace(conj)
-                if coll is not None:
-                    colls.append(coll.collocation)
+        # words only change with the lexicon version
+        lexicon = Lexicon.get_with_namespace_async()
+        generation = Collocation.get_generation_with_namespace()
+        if not_modified(self, word_name, lexicon.get_result().version, generation):
+            return
+        word, colls = Word.get_with_collocations_async(word_name).get_result()
 
         template_values = {
             'word': word,
-            'collocations': '\n'.join(colls)
+            'collocations': '\n'.join(coll.collocation for coll in colls)
         }
         template = JINJA_ENVIRONMENT.get_template('word.html')
         self.response.write(template.render(template_values))
@@ -140,10 +435,14 @@ class WordHandler(webapp2.RequestHandler):
         word_name = word_name.lower()
 
         word = Word.get_by_name_or_new_with_namespace(word_name)
+        old_forms = Lexicon.word_forms(word)
+        old_state = Lexicon.word_state(word)
         word.conjugative = self.request.get('conjugative').split()
         word.content = self.request.get('content')
         word.known = self.request.get('known') == 'known'
-        Word.put_with_namespace(word)
+        version = Lexicon.update_with_namespace([(old_forms, Lexicon.word_forms(word))],
+                                                [(old_state, word.known)], put=[word])
+        stats.lexicon_changed(version - 1)
         payload = {'success': True}
         return self.response.write(json.dumps(payload))
 
@@ -161,7 +460,10 @@ class DeleteWordHandler(webapp2.RequestHandler):
         if word is None:
             payload = {'success': False}
             return self.response.write(json.dumps(payload))
-        word.key.delete()
+        version = Lexicon.update_with_namespace([(Lexicon.word_forms(word), {})],
+                                                [(Lexicon.word_state(word), None)],
+                                                delete=[word.key])
+        stats.lexicon_changed(version - 1)
         payload = {'success': True}
         return self.response.write(json.dumps(payload))
 
@@ -169,89 +471,365 @@ class DeleteWordHandler(webapp2.RequestHandler):
 class ListWordsHandler(webapp2.RequestHandler):
 
     def get(self):
-        words = Word.get_all_words()
-        words = sorted(words, key=lambda w: w.name)
-
-        count_known = 0
-        count_unknown = 0
-        for word in words:
-            if word.known:
-                count_known += 1
-            else:
-                count_unknown += 1
+        cursor = self.request.get('cursor') or None
+        state = self.request.get('state')
+        prefix = self.request.get('prefix')
+        known = {'known': True, 'unknown': False}.get(state)
+        if not_modified(self, Lexicon.get_with_namespace().version):
+            return
+        future = Word.fetch_page_by_name_with_namespace_async(
+            WORDS_PAGE_SIZE, cursor, known=known, prefix=prefix)
+        count_known, count_unknown = Lexicon.get_counts_with_namespace()
+        words, next_cursor = future.get_result()
 
         template_values = {
             'words': words,
             'count_known': count_known,
             'count_unknown': count_unknown,
+            'state': state,
+            'prefix': prefix,
+            'next_cursor': next_cursor,
         }
 
         template = JINJA_ENVIRONMENT.get_template('words.html')
         self.response.write(template.render(template_values))
 
 
-class BackupWordsHandler(webapp2.RequestHandler):
+class SearchWordsHandler(webapp2.RequestHandler):
 
     def get(self):
+        query = self.request.get('q').strip()
+        limit = limit_param(self, SEARCH_LIMIT, MAX_SEARCH_LIMIT)
+        words = Word.search_with_namespace(query, limit) if query else []
+        payload = {'words': [{'name': word.name, 'known': word.known} for word in words]}
         self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
-        self.response.headers['Content-Disposition'] = 'attachment; filename=backup_words.json'
+        self.response.write(json.dumps(payload))
 
-        words = Word.get_all_words()
-        words = sorted(words, key=lambda w: w.name)
 
-        for word in words:
-            obj = {}
-            obj['name'] = word.name
-            obj['conjugative'] = [conj for conj in word.conjugative]
-            obj['content'] = word.content
-            obj['known'] = word.known
-            obj['date'] = word.date.strftime("%Y/%m/%d %H:%M:%S")
-            self.response.out.write(json.dumps(obj, ensure_ascii=False).encode('utf-8'))
-            self.response.out.write('\n')
+class FrequentWordsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        state = self.request.get('state', 'new')
+        if state not in ('known', 'unknown', 'new'):
+            self.abort(400)
+        limit = limit_param(self, FREQUENT_WORDS_LIMIT, MAX_FREQUENT_WORDS_LIMIT)
+        template_values = {
+            'words': stats.frequent_words(state, limit),
+            'state': state,
+            'limit': limit,
+        }
+        template = JINJA_ENVIRONMENT.get_template('frequent.html')
+        self.response.write(template.render(template_values))
+
+
+class BackupWordsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        compress = self.request.get('gzip') == '1'
+        cursor = self.request.get('cursor') or None
+        # the whole backup unless limited
+        limit = limit_param(self, 0)
+        if compress:
+            self.response.headers['Content-Type'] = 'application/gzip'
+            self.response.headers['Content-Disposition'] = 'attachment; filename=backup_words.json.gz'
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+            self.response.headers['Content-Disposition'] = 'attachment; filename=backup_words.json'
+            compressor = None
+
+        count = 0
+        while True:
+            size = BACKUP_BATCH_SIZE
+            if limit:
+                size = min(size, limit - count)
+            words, cursor = Word.fetch_page_by_name_with_namespace(size, cursor)
+            lines = []
+            for word in words:
+                obj = {}
+                obj['name'] = word.name
+                obj['conjugative'] = [conj for conj in word.conjugative]
+                obj['content'] = word.content
+                obj['known'] = word.known
+                obj['date'] = word.date.strftime("%Y/%m/%d %H:%M:%S")
+                lines.append(json.dumps(obj, ensure_ascii=False).encode('utf-8'))
+                lines.append('\n')
+            chunk = ''.join(lines)
+            self.response.out.write(compressor.compress(chunk) if compressor else chunk)
+            count += len(words)
+            if cursor is None or (limit and count >= limit):
+                break
+        if compressor:
+            self.response.out.write(compressor.flush())
+        if cursor is not None:
+            # pass back as ?cursor= to continue the backup
+            self.response.headers['X-Next-Cursor'] = cursor
+
+
+def upload_stream(upload):
+    if hasattr(upload, 'file'):
+        stream = upload.file
+    else:
+        if isinstance(upload, unicode):
+            upload = upload.encode('utf-8')
+        stream = StringIO.StringIO(upload)
+    if stream.read(2) == '\x1f\x8b':
+        stream.seek(0)
+        # the temporary file of an upload is opened w+b
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    stream.seek(0)
+    return stream
+
+
+def restore_words(lines):
+    """Restores backup lines in batches; returns created, updated, skipped."""
+    counts = [0, 0, 0]
+    changed_forms = set()
+    objs = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            counts[2] += 1
+            continue
+        if not obj.get('name'):
+            counts[2] += 1
+            continue
+        objs.append(obj)
+        if len(objs) >= RESTORE_BATCH_SIZE:
+            restored, forms = Word.restore_with_namespace(objs)
+            counts = [count + n for count, n in zip(counts, restored)]
+            changed_forms |= forms
+            objs = []
+    if objs:
+        restored, forms = Word.restore_with_namespace(objs)
+        counts = [count + n for count, n in zip(counts, restored)]
+        changed_forms |= forms
+    if counts[0] or counts[1]:
+        # once per restore; the forms of the new version are rebuilt
+        version = Lexicon.bump_with_namespace(changed_forms)
+        stats.lexicon_changed(version - 1)
+    return counts
 
 
 class RestoreWordsHandler(webapp2.RequestHandler):
 
     def post(self):
-        reader = StringIO.StringIO(self.request.get('json'))
-        words = []
-        for row in reader:
-            obj = json.loads(row)
-            self.response.out.write(obj['name'])
-            self.response.out.write('<br>')
-            word = Word.get_by_name_or_new_with_namespace(obj['name'])
-            word.conjugative = obj['conjugative']
-            word.content = obj['content']
-            word.known = obj['known']
-            word.date = datetime.strptime(obj['date'], '%Y/%m/%d %H:%M:%S')
-            words.append(word)
-        Word.put_multi_with_namespace(words)
+        lines = upload_stream(self.request.POST.get('json', ''))
+        defer = self.request.get('defer')
+        if defer == '':
+            # read ahead, so a compressed upload is measured as restored
+            head = []
+            size = 0
+            for line in lines:
+                head.append(line)
+                size += len(line)
+                if size > RESTORE_INLINE_SIZE:
+                    defer = '1'
+                    break
+            lines = itertools.chain(head, lines)
+        if defer == '1':
+            headers = {NAMESPACE_HEADER: user_namespace()}
+            tasks = []
+            oversized = []
+            chunk = []
+            size = 0
+            for line in itertools.chain(lines, [None]):
+                if line is not None and len(line) > RESTORE_TASK_SIZE:
+                    # does not fit in a task on its own
+                    oversized.append(line)
+                    continue
+                if line is None or (chunk and size + len(line) > RESTORE_TASK_SIZE):
+                    if chunk:
+                        # sent as is; params would be urlencoded, up to 3x larger
+                        tasks.append(taskqueue.Task(url='/tasks/words/restore', headers=headers,
+                                                    payload=''.join(chunk)))
+                    chunk = []
+                    size = 0
+                if line is not None:
+                    chunk.append(line)
+                    size += len(line)
+            # all built first, so a task too large fails before any is queued
+            queue = taskqueue.Queue('restore')
+            for i in range(0, len(tasks), RESTORE_TASKS_PER_ADD):
+                queue.add(tasks[i:i + RESTORE_TASKS_PER_ADD])
+            payload = {'success': True, 'tasks': len(tasks)}
+            if oversized:
+                created, updated, skipped = restore_words(oversized)
+                payload.update(created=created, updated=updated, skipped=skipped)
+            return self.response.write(json.dumps(payload))
+
+        created, updated, skipped = restore_words(lines)
+        payload = {'success': True, 'created': created, 'updated': updated, 'skipped': skipped}
+        return self.response.write(json.dumps(payload))
+
+
+class RestoreWordsTaskHandler(webapp2.RequestHandler):
+
+    def post(self):
+        namespace = self.request.headers[NAMESPACE_HEADER]
+        lines = StringIO.StringIO(self.request.body)
+        with namespace_context(namespace):
+            created, updated, skipped = restore_words(lines)
+        logging.info('restored words in %s: %d created, %d updated, %d skipped',
+                     namespace, created, updated, skipped)
 
 
 class UpdateCollocationHandler(webapp2.RequestHandler):
 
     def get(self):
-        documents = Document.get_all_with_namespace()
-        text = ''
-        collocations = defaultdict(list)
-        for document in documents:
-            text = re.sub(r'[\r\n]', ' ', document.content)
-            collocations = Processor.build_collocation(text, collocations)
-
-        colls = []
-        for k, v in collocations.items():
-            coll = Collocation.get_by_name_or_new_with_namespace(k)
-            coll.collocation = '\n'.join(v)
-            colls.append(coll)
-        Collocation.put_multi_with_namespace(colls)
+        rebuild = collocation.start_rebuild()
+        payload = {'success': True, 'id': rebuild.key.id()}
+        return self.response.write(json.dumps(payload))
 
-        payload = {'success': True}
+
+class CollocationStatusHandler(webapp2.RequestHandler):
+
+    def get(self):
+        id = self.request.get('id')
+        rebuild = None
+        if id != '':
+            rebuild = CollocationRebuild.get_with_namespace(int(id))
+        if rebuild is None:
+            payload = {'success': False}
+            return self.response.write(json.dumps(payload))
+        done_shards, done_partitions = collocation.progress(rebuild)
+        payload = {
+            'success': True,
+            'status': rebuild.status,
+            'fanout_done': rebuild.fanout_done,
+            'num_documents': rebuild.num_documents,
+            'num_shards': rebuild.num_shards,
+            'done_shards': done_shards,
+            'num_partitions': rebuild.num_partitions,
+            'done_partitions': done_partitions,
+            'num_collocations': rebuild.num_collocations,
+            'started': rebuild.started.strftime("%Y/%m/%d %H:%M:%S"),
+            'updated': rebuild.updated.strftime("%Y/%m/%d %H:%M:%S"),
+        }
         return self.response.write(json.dumps(payload))
 
 
-app = webapp2.WSGIApplication([
+class CollocationTaskHandler(webapp2.RequestHandler):
+
+    def post(self, stage):
+        rebuild_key = ndb.Key(urlsafe=self.request.get('rebuild'))
+        with namespace_context(rebuild_key.namespace()):
+            if stage == 'fanout':
+                collocation.fanout(rebuild_key, self.request.get('cursor'),
+                                   int(self.request.get('shard')))
+            elif stage == 'shard':
+                ids = [int(id) for id in self.request.get('ids').split(',')]
+                collocation.process_shard(rebuild_key, int(self.request.get('shard')), ids)
+            else:
+                collocation.merge(rebuild_key, int(self.request.get('partition')))
+
+
+class CollocationDocumentTaskHandler(webapp2.RequestHandler):
+
+    def post(self):
+        with namespace_context(self.request.get('namespace')):
+            collocation.update_document(int(self.request.get('id')),
+                                        int(self.request.get('revision')))
+
+
+class StatsTaskHandler(webapp2.RequestHandler):
+
+    def post(self, stage):
+        with namespace_context(self.request.get('namespace')):
+            if not stats.acquire_lease():
+                # another task of the namespace is running; retried later
+                self.response.set_status(503)
+                return
+            try:
+                self.run(stage)
+            finally:
+                stats.release_lease()
+
+    def run(self, stage):
+        if stage == 'lexicon':
+            count = stats.recount(int(self.request.get('since')))
+            logging.info('recounted %d documents', count)
+        elif stage == 'update':
+            ids = [int(id) for id in self.request.get('ids').split(',')]
+            for document in Document.get_multi_with_namespace(ids):
+                if document is not None:
+                    stats.update_document(document)
+        else:
+            for id in self.request.get('ids').split(','):
+                stats.remove_document(int(id))
+
+
+class AdminStatsHandler(webapp2.RequestHandler):
+
+    def get(self):
+        if not users.is_current_user_admin():
+            self.abort(403)
+        payload = {
+            'instance': os.environ.get('INSTANCE_ID'),
+            'profile_rate': profiling.PROFILE_RATE,
+            'routes': profiling.summary(),
+        }
+        if self.request.get('profiles') == '1':
+            payload['profiles'] = profiling.profiles()
+        self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        return self.response.write(json.dumps(payload, indent=1, sort_keys=True))
+
+
+class MigrateKeysHandler(webapp2.RequestHandler):
+
+    def post(self):
+        migration = migrate.start_migration()
+        payload = {'success': True, 'id': migration.key.id()}
+        return self.response.write(json.dumps(payload))
+
+
+class MigrateStatusHandler(webapp2.RequestHandler):
+
+    def get(self):
+        id = self.request.get('id')
+        migration = None
+        if id != '':
+            migration = KeyMigration.get_with_namespace(int(id))
+        if migration is None:
+            payload = {'success': False}
+            return self.response.write(json.dumps(payload))
+        payload = {
+            'success': True,
+            'stage': migration.stage,
+            'num_words': migration.num_words,
+            'num_indexed': migration.num_indexed,
+            'num_collocations': migration.num_collocations,
+            'started': migration.started.strftime("%Y/%m/%d %H:%M:%S"),
+            'updated': migration.updated.strftime("%Y/%m/%d %H:%M:%S"),
+        }
+        return self.response.write(json.dumps(payload))
+
+
+class MigrateTaskHandler(webapp2.RequestHandler):
+
+    def post(self, stage):
+        migration_key = ndb.Key(urlsafe=self.request.get('migration'))
+        with namespace_context(migration_key.namespace()):
+            migrate.run_page(migration_key, stage, self.request.get('cursor'),
+                             int(self.request.get('page')))
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    """Loads the templates before traffic arrives."""
+
+    def get(self):
+        for name in JINJA_ENVIRONMENT.list_templates(extensions=['html']):
+            JINJA_ENVIRONMENT.get_template(name)
+
+
+application = webapp2.WSGIApplication([
     ('/', MainPageHandler),
     ('/doc/(\d+)', ShowDocumentHandler),
+    ('/doc/(\d+)/words', DocumentWordsHandler),
+    ('/doc/(\d+)/section/(\d+)', DocumentSectionHandler),
     ('/doc/new', EditDocumentHandler),
     ('/doc/edit', EditDocumentHandler),
     ('/doc/save', EditDocumentHandler),
@@ -259,7 +837,21 @@ app = webapp2.WSGIApplication([
     ('/word', WordHandler),
     ('/word/delete', DeleteWordHandler),
     ('/words', ListWordsHandler),
+    ('/words/search', SearchWordsHandler),
+    ('/words/frequent', FrequentWordsHandler),
     ('/words/backup', BackupWordsHandler),
     ('/words/restore', RestoreWordsHandler),
+    ('/tasks/words/restore', RestoreWordsTaskHandler),
     ('/collocation/update', UpdateCollocationHandler),
+    ('/collocation/status', CollocationStatusHandler),
+    ('/tasks/collocation/(fanout|shard|merge)', CollocationTaskHandler),
+    ('/tasks/collocation/document', CollocationDocumentTaskHandler),
+    ('/tasks/stats/(lexicon|update|remove)', StatsTaskHandler),
+    ('/tasks/migrate/(words|search|collocations)', MigrateTaskHandler),
+    ('/admin/stats', AdminStatsHandler),
+    ('/migrate/keys', MigrateKeysHandler),
+    ('/migrate/status', MigrateStatusHandler),
+    ('/_ah/warmup', WarmupHandler),
 ], debug=True)
+
+app = profiling.ProfilingMiddleware(application)
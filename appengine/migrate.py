@@ -0,0 +1,71 @@
+# coding:utf-8
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from db import Collocation, KeyMigration, Word, user_namespace
+
+# a migration runs its stages in order, one task per page: words under
+# numeric ids are re-keyed by name, all words are rewritten with their
+# search grams and collocations under numeric ids are deleted. Each task
+# records its page in the KeyMigration and enqueues the next one in the
+# same transaction.
+QUEUE_NAME = 'migrate'
+STAGES = ['words', 'search', 'collocations']
+COUNTS = {
+    'words': 'num_words',
+    'search': 'num_indexed',
+    'collocations': 'num_collocations',
+}
+
+
+def enqueue(migration_key, stage, cursor, page):
+    params = {
+        'migration': migration_key.urlsafe(),
+        'cursor': cursor.urlsafe() if cursor is not None else '',
+        'page': page,
+    }
+    taskqueue.add(url='/tasks/migrate/' + stage, params=params, queue_name=QUEUE_NAME,
+                  transactional=ndb.in_transaction())
+
+
+def start_migration():
+    migration = KeyMigration(namespace=user_namespace())
+    migration.stage = STAGES[0]
+    migration.put()
+    enqueue(migration.key, STAGES[0], None, 0)
+    return migration
+
+
+def run_page(migration_key, stage, cursor, page):
+    migration = migration_key.get()
+    if migration.stage != stage or migration.page != page:
+        # a retry after the page was recorded
+        return
+    start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    if stage == 'words':
+        count, next_cursor = Word.migrate_keys_with_namespace(start_cursor)
+    elif stage == 'search':
+        count, next_cursor = Word.reindex_with_namespace(start_cursor)
+    else:
+        count, next_cursor = Collocation.delete_numeric_ids_with_namespace(start_cursor)
+
+    @ndb.transactional
+    def txn():
+        migration = migration_key.get()
+        if migration.stage != stage or migration.page != page:
+            return
+        setattr(migration, COUNTS[stage], getattr(migration, COUNTS[stage]) + count)
+        if next_cursor is not None:
+            migration.page += 1
+            enqueue(migration_key, stage, next_cursor, migration.page)
+        else:
+            index = STAGES.index(stage) + 1
+            migration.stage = STAGES[index] if index < len(STAGES) else 'done'
+            migration.page = 0
+            if migration.stage != 'done':
+                enqueue(migration_key, migration.stage, None, 0)
+        migration.put()
+
+    txn()
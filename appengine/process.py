@@ -1,37 +1,127 @@
 # coding:utf-8
 
+import hashlib
 import re
 from collections import Counter
 
-from db import Word
+import lemmatize
+from db import Lexicon
+from formtable import KNOWN, FormTable
 
-REF_PAT = re.compile(ur'([a-zA-Z]+)(\d+([-–,]\d+)*)$', re.UNICODE)
+SPLIT_PAT = re.compile(r'[ \t]+')
+# leading punctuation, then either a word followed by a reference number
+# (e.g. "word12" or "word3-5") or any other core, then trailing punctuation
+TOKEN_PAT = re.compile(ur'([“"(]*)'
+                       ur'(?:.*?([a-zA-Z]+)(\d+(?:[-–,]\d+)*)|(.*?))'
+                       ur'((?:[.,:;?!”")]|\'s)*)$', re.UNICODE)
 WORD_PAT = re.compile(r'[a-zA-Z]+')
+HEADING_PAT = re.compile(r'#{1,5} ')
 
 COLLOCATION_LEN = 20
 NUM_COLLOCATIONS = 100
+SECTION_SIZE = 16 * 1024
+
+
+def tokenize(line):
+    """Yields (leading, word, trailing, ref) for each token in a line.
+
+    Text before a reference number's word is dropped, as it always was.
+    """
+    for token in SPLIT_PAT.split(line):
+        if token.isalpha():
+            yield '', token, '', ''
+            continue
+        m = TOKEN_PAT.match(token)
+        if m.group(2) is None:
+            yield m.group(1), m.group(4), m.group(5), ''
+        else:
+            yield m.group(1), m.group(2), m.group(5), m.group(3)
+
+
+def split_sections(text, size=SECTION_SIZE):
+    """Splits the lines of text into sections.
+
+    A section starts at each heading, and sections longer than size
+    characters are cut into pages at line boundaries.
+    """
+    sections = []
+    lines = []
+    length = 0
+    for line in text.splitlines():
+        if lines and (length >= size or HEADING_PAT.match(line)):
+            sections.append(lines)
+            lines = []
+            length = 0
+        lines.append(line)
+        length += len(line) + 1
+    if lines or not sections:
+        sections.append(lines)
+    return sections
+
+
+def line_hash(line):
+    return hashlib.sha1(line.encode('utf-8')).hexdigest()[:16]
 
 
 class Processor(object):
 
-    def __init__(self):
+    def __init__(self, lexicon=None, neutral=False, forms=None):
         self.count_words = 0
         self.count_known_words = 0
         self.count_unknown_words = 0
         self.count_new_words = 0
         self.counter = Counter()
-        self.known_words = Word.get_all_known_words()
-        self.unknown_words = Word.get_all_unknown_words()
+        # neutral links carry no word state; main.js applies it instead
+        self.neutral = neutral
+        if neutral:
+            forms = FormTable()
+        elif forms is None:
+            forms = Lexicon.get_forms_with_namespace(lexicon)
+        self.lexicon = forms
+        # probed once per token
+        self.index = forms.index
+        self.lemmas = forms.lemmas
 
     def process_document(self, document):
         document.title = self.process_text(document.title)
         document.content = self.process_text(document.content)
 
     def process_text(self, text):
-        out = []
-        for line in text.splitlines():
-            out.append(self.process_line(line))
-        return '<br>'.join(out)
+        return '<br>'.join(self.iter_text(text))
+
+    def iter_text(self, text):
+        """Yields the rendered lines of text one at a time."""
+        return self.iter_lines(text.splitlines())
+
+    def iter_lines(self, lines):
+        for line in lines:
+            yield self.process_line(line)
+
+    def iter_line_entries(self, lines, cached=None):
+        """Yields [hash, html, words, known, unknown, new] for each line.
+
+        Lines whose hash is in cached reuse its entry, rendered under the
+        same word states, and only add its counts; their forms are not
+        added to counter.
+        """
+        cached = cached or {}
+        for line in lines:
+            key = line_hash(line)
+            entry = cached.get(key)
+            if entry is None:
+                before = self.counts()
+                html = self.process_line(line)
+                entry = [key, html] + [after - count for after, count in zip(self.counts(), before)]
+            else:
+                self.count_words += entry[2]
+                self.count_known_words += entry[3]
+                self.count_unknown_words += entry[4]
+                self.count_new_words += entry[5]
+            yield entry
+
+    def counts(self):
+        return (self.count_words, self.count_known_words, self.count_unknown_words,
+                self.count_new_words)
 
     def process_line(self, line):
         out = []
@@ -57,58 +147,41 @@ class Processor(object):
             line = line[2:]
             pre = '<h1>'
             suf = '</h1>'
-        for word in re.split(r'[ \t]+', line):
-            out.append(self.process_word(word))
+        for leading, word, trailing, ref in tokenize(line):
+            out.append(leading + self.process_word(word) + ref + trailing)
         return pre + ' '.join(out) + suf
 
     def process_word(self, word):
         if len(word) > 1 and word.isalpha():
             self.count_words += 1
-            self.counter[word.lower()] += 1
-            if word.lower() in self.known_words:
-                self.count_known_words += 1
-                return self.known_word_link(word, self.known_words[word.lower()])
-            elif word.lower() in self.unknown_words:
-                self.count_unknown_words += 1
-                return self.unknown_word_link(word, self.unknown_words[word.lower()])
-            else:
+            lower = word.lower()
+            self.counter[lower] += 1
+            if self.neutral:
+                return self.neutral_word_link(word, lower)
+            value = self.index.get(lower)
+            if value is None:
+                value = lemmatize.lookup(self.index, lower)
+            if value is None:
                 self.count_new_words += 1
                 return self.word_link(word)
-        elif word.endswith('.'):
-            return self.process_word(word[:-1]) + '.'
-        elif word.endswith(','):
-            return self.process_word(word[:-1]) + ','
-        elif word.endswith(':'):
-            return self.process_word(word[:-1]) + ':'
-        elif word.endswith(';'):
-            return self.process_word(word[:-1]) + ';'
-        elif word.endswith('?'):
-            return self.process_word(word[:-1]) + '?'
-        elif word.endswith('!'):
-            return self.process_word(word[:-1]) + '!'
-        elif word.startswith('"'):
-            return '"' + self.process_word(word[1:])
-        elif word.endswith('"'):
-            return self.process_word(word[:-1]) + '"'
-        elif word.startswith(u'“'):
-            return u'“' + self.process_word(word[1:])
-        elif word.endswith(u'”'):
-            return self.process_word(word[:-1]) + u'”'
-        elif word.startswith('('):
-            return '(' + self.process_word(word[1:])
-        elif word.endswith(')'):
-            return self.process_word(word[:-1]) + ')'
-        elif word.endswith('\'s'):
-            return self.process_word(word[:-2]) + '\'s'
-        else:
-            m = REF_PAT.search(word)
-            if m:
-                return self.process_word(m.group(1)) + m.group(2)
-            return word
+            elif value & KNOWN:
+                self.count_known_words += 1
+                return self.known_word_link(word, self.lemmas[value >> 1])
+            else:
+                self.count_unknown_words += 1
+                return self.unknown_word_link(word, self.lemmas[value >> 1])
+        return word
+
+    def dependent_forms(self):
+        """Returns the forms whose changes affect the processed text."""
+        return lemmatize.dependent_forms(self.lexicon, self.counter)
 
     def word_link(self, word):
         return '<a href="/word?name=' + word.lower() + '" class="new" data-toggle="modal" data-target="#wordModal">' + word + '</a>'
 
+    def neutral_word_link(self, word, form):
+        return '<a href="/word?name=' + form + '" data-form="' + form + '" data-toggle="modal" data-target="#wordModal">' + word + '</a>'
+
     def known_word_link(self, word, orig):
         return '<a href="/word?name=' + orig + '" class="known" data-toggle="modal" data-target="#wordModal">' + word + '</a>'
 
@@ -116,18 +189,17 @@ class Processor(object):
         return '<a href="/word?name=' + orig + '" class="unknown" data-toggle="modal" data-target="#wordModal">' + word + '</a>'
 
     @staticmethod
-    def build_collocation(text, collocations):
-        index = 0
-        while True:
-            m = WORD_PAT.search(text[index:])
-            if m:
-                word = m.group(0)
-                if len(word) > 2 and len(collocations[word.lower()]) < NUM_COLLOCATIONS:
-                    s = index + m.start()
-                    prefix = text[max(0, s - COLLOCATION_LEN):s].ljust(COLLOCATION_LEN)
-                    suffix = text[s + len(word):s + len(word) + COLLOCATION_LEN]
-                    collocations[word.lower()].append(prefix + word + suffix)
-                index += m.end()
-            else:
-                break
+    def build_collocation(text, collocations, window=COLLOCATION_LEN):
+        for m in WORD_PAT.finditer(text):
+            start, end = m.span()
+            if end - start <= 2:
+                continue
+            word = m.group(0)
+            found = collocations[word.lower()]
+            if len(found) >= NUM_COLLOCATIONS:
+                continue
+            prefix = text[max(0, start - window):start]
+            if start < window:
+                prefix = prefix.ljust(window)
+            found.append(prefix + word + text[end:end + window])
         return collocations
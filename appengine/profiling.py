@@ -0,0 +1,178 @@
+# coding:utf-8
+
+import contextlib
+import os
+import random
+import re
+import StringIO
+import threading
+import time
+from collections import defaultdict, deque
+
+from google.appengine.api import apiproxy_stub_map
+
+# fraction of requests run under cProfile, set in app.yaml
+PROFILE_RATE = float(os.environ.get('PROFILE_RATE', '0'))
+HISTORY_SIZE = 1000
+NUM_PROFILES = 20
+PROFILE_LINES = 40
+PERCENTILES = (50, 90, 99)
+ID_PAT = re.compile(r'/\d+')
+
+_local = threading.local()
+_lock = threading.Lock()
+_history = defaultdict(lambda: deque(maxlen=HISTORY_SIZE))
+_profiles = deque(maxlen=NUM_PROFILES)
+
+
+class RequestRecord(object):
+    """Timings and API calls of the current request.
+
+    Phases are timed exclusively: entering a nested phase pauses the
+    enclosing one, so the phases add up to at most the request time.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.duration = None
+        self.phases = defaultdict(float)
+        self.stack = []
+        self.rpcs = defaultdict(int)
+        self.rpc_bytes = 0
+
+    def enter(self, name):
+        now = time.time()
+        if self.stack:
+            parent, start = self.stack[-1]
+            self.phases[parent] += now - start
+        self.stack.append((name, now))
+
+    def exit(self):
+        now = time.time()
+        name, start = self.stack.pop()
+        self.phases[name] += now - start
+        if self.stack:
+            self.stack[-1] = (self.stack[-1][0], now)
+
+
+def current():
+    return getattr(_local, 'record', None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Times a block of the current request as the named phase."""
+    record = current()
+    if record is None:
+        yield
+        return
+    record.enter(name)
+    try:
+        yield
+    finally:
+        record.exit()
+
+
+def timed_iter(name, iterable):
+    """Yields the items of iterable, timing their production as a phase.
+
+    Streamed lines are produced while the template renders, so this
+    separates processing from rendering.
+    """
+    iterator = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def _post_call_hook(service, call, request, response):
+    record = current()
+    if record is not None:
+        record.rpcs['%s.%s' % (service, call)] += 1
+        record.rpc_bytes += request.ByteSize() + response.ByteSize()
+
+
+def route(path):
+    return ID_PAT.sub('/<id>', path)
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of sorted values, nearest rank."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def summary():
+    """Returns per-route percentiles and means of this instance's requests."""
+    with _lock:
+        history = dict((key, list(records)) for key, records in _history.iteritems())
+    routes = {}
+    for key, records in history.iteritems():
+        durations = sorted(record.duration for record in records)
+        phases = defaultdict(float)
+        rpcs = defaultdict(int)
+        for record in records:
+            for name, seconds in record.phases.iteritems():
+                phases[name] += seconds
+            for name, count in record.rpcs.iteritems():
+                rpcs[name] += count
+        n = float(len(records))
+        routes[key] = {
+            'count': len(records),
+            'ms': dict(('p%d' % p, percentile(durations, p) * 1000) for p in PERCENTILES),
+            'phase_ms': dict((name, seconds / n * 1000) for name, seconds in phases.iteritems()),
+            'rpcs': dict((name, count / n) for name, count in rpcs.iteritems()),
+            'rpc_bytes': sum(record.rpc_bytes for record in records) / n,
+        }
+    return routes
+
+
+def profiles():
+    with _lock:
+        return list(_profiles)
+
+
+class ProfilingMiddleware(object):
+    """WSGI middleware recording the timings of each request by route."""
+
+    def __init__(self, app):
+        self.app = app
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('profiling', _post_call_hook)
+
+    def __call__(self, environ, start_response):
+        record = _local.record = RequestRecord()
+        profiler = None
+        if PROFILE_RATE and random.random() < PROFILE_RATE:
+            import cProfile
+            profiler = cProfile.Profile()
+        try:
+            if profiler is not None:
+                return profiler.runcall(self.app, environ, start_response)
+            return self.app(environ, start_response)
+        finally:
+            _local.record = None
+            record.duration = time.time() - record.start
+            key = '%s %s' % (environ.get('REQUEST_METHOD'), route(environ.get('PATH_INFO', '')))
+            with _lock:
+                _history[key].append(record)
+            if profiler is not None:
+                self.save_profile(key, record, profiler)
+
+    @staticmethod
+    def save_profile(key, record, profiler):
+        import pstats
+        out = StringIO.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+        with _lock:
+            _profiles.append({
+                'route': key,
+                'start': record.start,
+                'ms': record.duration * 1000,
+                'profile': out.getvalue(),
+            })
@@ -0,0 +1,50 @@
+# coding:utf-8
+
+import re
+
+GRAM_SIZE = 3
+# grams of the meanings too; every word put then writes far more index
+# rows, and words saved before the change need a reindex
+INDEX_CONTENT = False
+MAX_CONTENT_TERMS = 100
+# gram matches fetched per result, some are dropped by matches
+OVERFETCH = 2
+WORD_PAT = re.compile(r'\w+', re.UNICODE)
+
+
+def terms(name, conjugative, content):
+    """Returns the lowercase strings a word is found by."""
+    result = [name or ''] + list(conjugative)
+    if INDEX_CONTENT and content:
+        result += sorted(set(WORD_PAT.findall(content.lower())))[:MAX_CONTENT_TERMS]
+    return [term.lower() for term in result if term]
+
+
+def grams(terms):
+    """Returns the distinct n-grams of terms, sorted."""
+    result = set()
+    for term in terms:
+        for i in range(len(term) - GRAM_SIZE + 1):
+            result.add(term[i:i + GRAM_SIZE])
+    return sorted(result)
+
+
+def query_grams(query):
+    """Returns grams covering every character of query.
+
+    Non-overlapping grams are enough to narrow the candidates, so a long
+    query does not add a filter per character. query is at least
+    GRAM_SIZE long.
+    """
+    starts = range(0, len(query) - GRAM_SIZE + 1, GRAM_SIZE)
+    if starts[-1] != len(query) - GRAM_SIZE:
+        starts.append(len(query) - GRAM_SIZE)
+    return sorted(set(query[i:i + GRAM_SIZE] for i in starts))
+
+
+def matches(terms, query):
+    """Whether query is a substring of one of terms.
+
+    The grams of a query may come from different terms of a word.
+    """
+    return any(query in term for term in terms)
@@ -0,0 +1,216 @@
+# coding:utf-8
+
+import hashlib
+import time
+from datetime import datetime, timedelta
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import lemmatize
+from db import BATCH_SIZE, DocumentStats, FormIndex, Lexicon, StatsState, user_namespace
+from process import Processor
+
+QUEUE_NAME = 'stats'
+# seconds a task holds the lease of its namespace, the task deadline
+LEASE_TIME = 10 * 60
+RECOUNT_DELAY = 10
+SORT_KEYS = {
+    'known': lambda stats: -stats.known_ratio,
+    'unknown': lambda stats: -stats.unknown_ratio,
+    'new': lambda stats: -stats.new_ratio,
+}
+
+
+def document_counter(document):
+    processor = Processor(neutral=True)
+    for text in (document.title, document.content):
+        for _ in processor.iter_text(text):
+            pass
+    return processor.counter
+
+
+def update_index(document_id, old_counter, new_counter, forms):
+    """Sets the count of a document in the indexes of its changed forms."""
+    changed = [form for form in set(old_counter) | set(new_counter)
+               if old_counter.get(form) != new_counter.get(form)]
+    for i in range(0, len(changed), BATCH_SIZE):
+        indexes = FormIndex.get_multi_by_form_or_new_with_namespace(changed[i:i + BATCH_SIZE])
+        for index in indexes:
+            index.set_count(document_id, new_counter.get(index.key.id(), 0))
+            index.set_state(forms)
+        ndb.put_multi([index for index in indexes if index.documents])
+        ndb.delete_multi([index.key for index in indexes if not index.documents])
+
+
+def update_document(document):
+    """Recomputes the statistics of a saved document."""
+    document_id = document.key.id()
+    stats = DocumentStats.get_multi_with_namespace([document_id])[0]
+    old_counter = stats.counter if stats is not None else {}
+    if stats is None:
+        stats = DocumentStats(id=document_id, namespace=document.key.namespace())
+    lexicon = Lexicon.get_with_namespace()
+    forms = Lexicon.get_forms_with_namespace(lexicon)
+    stats.revision = document.revision
+    stats.lexicon_version = lexicon.version
+    stats.counter = dict(document_counter(document))
+    stats.count(forms)
+    # the index is idempotent, so a retried task may update it again
+    update_index(document_id, old_counter, stats.counter, forms)
+    stats.put()
+    return stats
+
+
+def remove_document(document_id):
+    stats = DocumentStats.get_multi_with_namespace([document_id])[0]
+    if stats is None:
+        return
+    # the forms still in other documents keep their state
+    update_index(document_id, stats.counter, {}, Lexicon.get_forms_with_namespace())
+    stats.key.delete()
+
+
+@ndb.transactional
+def acquire_lease():
+    """Takes the lease on the statistics of the namespace; False if held."""
+    key = StatsState.key_for()
+    state = key.get() or StatsState(key=key)
+    now = datetime.utcnow()
+    if state.lease_until is not None and state.lease_until > now:
+        return False
+    state.lease_until = now + timedelta(seconds=LEASE_TIME)
+    state.put()
+    return True
+
+
+@ndb.transactional
+def release_lease():
+    state = StatsState.key_for().get()
+    state.lease_until = None
+    state.put()
+
+
+def enqueue_documents(stage, document_ids, name=None):
+    """Enqueues updates of document statistics.
+
+    Tasks of different namespaces run concurrently; within a namespace
+    the lease keeps the counts of the form indexes from being written
+    concurrently. A named task is enqueued once; adding it again is
+    ignored.
+    """
+    if not document_ids:
+        return
+    try:
+        taskqueue.add(url='/tasks/stats/' + stage, queue_name=QUEUE_NAME, name=name,
+                      params={'namespace': user_namespace(),
+                              'ids': ','.join(str(id) for id in document_ids)})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def backfill_documents(document_ids):
+    """Enqueues the statistics of documents saved before they were kept.
+
+    The task is named after the documents, so index page views made
+    before it runs do not enqueue it again.
+    """
+    ids = sorted(document_ids)
+    key = '%s:%s' % (user_namespace(), ','.join(str(id) for id in ids))
+    enqueue_documents('update', ids, name='backfill-' + hashlib.sha1(key).hexdigest())
+
+
+def lexicon_changed(since):
+    """Enqueues a recount of the documents affected by changes after since.
+
+    The changes of a namespace within RECOUNT_DELAY seconds share one
+    task, run at the end of that window.
+    """
+    namespace = user_namespace()
+    now = time.time()
+    window = int(now // RECOUNT_DELAY)
+    name = 'lexicon-%s-%d' % (hashlib.sha1(namespace).hexdigest()[:20], window)
+    try:
+        taskqueue.add(url='/tasks/stats/lexicon', queue_name=QUEUE_NAME, name=name,
+                      countdown=(window + 1) * RECOUNT_DELAY - now + 1,
+                      params={'namespace': namespace, 'since': since})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def recount(since):
+    """Recounts the documents and forms changed in the lexicon after since.
+
+    A coalesced task carries the since of the first change of its
+    window; the changes after the previous recount are included too.
+    """
+    lexicon = Lexicon.get_with_namespace()
+    forms = Lexicon.get_forms_with_namespace(lexicon)
+    state = StatsState.key_for().get()
+    if state is not None and state.version is not None:
+        since = min(since, state.version)
+    changed = lexicon.changes_since(since)
+    if changed is None:
+        # too many changes to tell the documents apart
+        stats = DocumentStats.get_all_with_namespace()
+        indexes = list(FormIndex.iter_all_with_namespace())
+    else:
+        # forms resolved through a changed lemma are affected as well
+        for form in list(changed):
+            changed.update(lemmatize.inflections(form))
+        changed = list(changed)
+        indexes = []
+        for i in range(0, len(changed), BATCH_SIZE):
+            indexes += FormIndex.get_multi_by_form_with_namespace(changed[i:i + BATCH_SIZE])
+        indexes = [index for index in indexes if index is not None]
+        ids = set()
+        for index in indexes:
+            ids.update(index.documents)
+        stats = DocumentStats.get_multi_with_namespace(list(ids))
+
+    indexes = [index for index in indexes if index.set_state(forms)]
+    for i in range(0, len(indexes), BATCH_SIZE):
+        ndb.put_multi(indexes[i:i + BATCH_SIZE])
+    stats = [s for s in stats if s is not None and s.lexicon_version < lexicon.version]
+    for s in stats:
+        s.lexicon_version = lexicon.version
+        s.count(forms)
+    for i in range(0, len(stats), BATCH_SIZE):
+        DocumentStats.put_multi_with_namespace(stats[i:i + BATCH_SIZE])
+    set_version(lexicon.version)
+    return len(stats)
+
+
+@ndb.transactional
+def set_version(version):
+    key = StatsState.key_for()
+    state = key.get() or StatsState(key=key)
+    state.version = version
+    state.put()
+
+
+def frequent_words(state, limit):
+    """Returns the most frequent forms in a state as (form, name, frequency)."""
+    indexes = FormIndex.fetch_frequent_with_namespace(state, limit)
+    return [(index.key.id(), index.name, index.frequency) for index in indexes]
+
+
+def documents_containing(forms):
+    """Returns the ids of the documents containing any of forms."""
+    ids = set()
+    for index in FormIndex.get_multi_by_form_with_namespace(list(forms)):
+        if index is not None:
+            ids.update(index.documents)
+    return ids
+
+
+def sort_documents(documents, stats, sort='', max_new=None):
+    """Returns (document, stats) pairs sorted and filtered by difficulty."""
+    pairs = zip(documents, stats)
+    if max_new is not None:
+        pairs = [(d, s) for d, s in pairs if s is not None and s.new_ratio <= max_new]
+    if sort in SORT_KEYS:
+        key = SORT_KEYS[sort]
+        # documents without statistics go last
+        pairs.sort(key=lambda pair: (pair[1] is None, key(pair[1]) if pair[1] else 0))
+    return pairs
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""Benchmarks Processor.build_collocation on synthetic documents.
+
+Compares the current implementation with the previous one, which sliced
+the remaining text on every match. Needs the App Engine SDK importable,
+e.g. PYTHONPATH=<sdk root>/platform/google_appengine.
+
+    python benchmarks/bench_collocation.py --sizes 0.25,0.5,1,2,4
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'appengine'))
+
+from process import COLLOCATION_LEN, NUM_COLLOCATIONS, WORD_PAT, Processor
+
+
+def build_collocation_sliced(text, collocations):
+    index = 0
+    while True:
+        m = WORD_PAT.search(text[index:])
+        if m:
+            word = m.group(0)
+            if len(word) > 2 and len(collocations[word.lower()]) < NUM_COLLOCATIONS:
+                s = index + m.start()
+                prefix = text[max(0, s - COLLOCATION_LEN):s].ljust(COLLOCATION_LEN)
+                suffix = text[s + len(word):s + len(word) + COLLOCATION_LEN]
+                collocations[word.lower()].append(prefix + word + suffix)
+            index += m.end()
+        else:
+            break
+    return collocations
+
+
+def make_text(size, vocabulary, rng):
+    words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 10)))
+             for _ in range(vocabulary)]
+    out = []
+    length = 0
+    while length < size:
+        word = rng.choice(words)
+        if rng.random() < 0.1:
+            word = word.capitalize()
+        if rng.random() < 0.1:
+            word += rng.choice('.,;:')
+        out.append(word)
+        length += len(word) + 1
+    return ' '.join(out)[:size]
+
+
+def measure(func, text, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func(text, defaultdict(list))
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='0.25,0.5,1,2,4',
+                        help='document sizes in megabytes, comma separated')
+    parser.add_argument('--vocabulary', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--max-sliced-size', type=float, default=1,
+                        help='largest size in megabytes to run the sliced version on')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print('%10s %12s %12s %14s' % ('size (MB)', 'finditer (s)', 'sliced (s)', 'finditer s/MB'))
+    for size in [float(s) for s in args.sizes.split(',')]:
+        text = make_text(int(size * 1024 * 1024), args.vocabulary, rng)
+        current = measure(Processor.build_collocation, text, args.repeat)
+        if size <= args.max_sliced_size:
+            sliced = '%12.3f' % measure(build_collocation_sliced, text, args.repeat)
+        else:
+            sliced = '%12s' % '-'
+        print('%10.2f %12.3f %s %14.3f' % (size, current, sliced, current / size))
+
+
+if __name__ == '__main__':
+    main()
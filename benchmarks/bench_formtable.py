@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""Compares the FormTable lexicon snapshot with the former JSON dict.
+
+Reports the cached blob size, the time to load it and the memory held by
+the loaded structure for lexicons of several sizes.
+
+    python benchmarks/bench_formtable.py --sizes 1000,10000,100000
+"""
+
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'appengine'))
+
+from formtable import FormTable
+
+CONJUGATIONS = ['s', 'ed', 'ing']
+
+
+def make_forms(size, rng):
+    forms = {}
+    while len(forms) < size:
+        lemma = u''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10)))
+        known = rng.random() < 0.5
+        forms[lemma] = [lemma, known]
+        for suffix in CONJUGATIONS:
+            if rng.random() < 0.5:
+                forms[lemma + suffix] = [lemma, known]
+    return forms
+
+
+def deep_size(obj, seen=None):
+    """Returns the bytes held by obj and the objects it refers to once."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif isinstance(obj, FormTable):
+        size += deep_size(obj.index, seen) + deep_size(obj.lemmas, seen)
+    return size
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='numbers of forms, comma separated')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print('%8s %-10s %10s %10s %12s' % ('forms', 'format', 'blob (KB)', 'load (ms)', 'memory (KB)'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        forms = make_forms(size, rng)
+        json_blob = zlib.compress(json.dumps(forms, separators=(',', ':')))
+        table_blob = FormTable.from_dict(forms).dumps()
+        cases = [
+            ('json', json_blob, lambda: json.loads(zlib.decompress(json_blob))),
+            ('formtable', table_blob, lambda: FormTable.loads(table_blob)),
+        ]
+        for name, blob, load in cases:
+            elapsed, loaded = best_time(load, args.repeat)
+            print('%8d %-10s %10.1f %10.1f %12.1f' % (len(forms), name, len(blob) / 1024.0,
+                                                      elapsed * 1000, deep_size(loaded) / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""Benchmarks the request hot paths against the App Engine testbed.
+
+Builds synthetic lexicons and documents at each scale, runs the handlers
+through main.app with the datastore, memcache and task queue stubs, and
+writes latency, RPC counts and peak memory per case as JSON. Needs the
+App Engine SDK importable, e.g.
+PYTHONPATH=<sdk root>/platform/google_appengine:<sdk root>/platform/google_appengine/lib/webapp2-2.5.2:...
+
+    python benchmarks/bench_handlers.py --words 1000,10000 --doc-sizes 1,100,1000 -o bench.json
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import string
+import sys
+import time
+import urllib
+from collections import Counter, defaultdict
+from datetime import datetime
+
+APPENGINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'appengine')
+sys.path.insert(0, APPENGINE_DIR)
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+USER_EMAIL = 'bench@example.com'
+SUFFIXES = ['', '', '', 's', 'ed', 'ing']
+
+
+class RpcCounter(object):
+    """Counts the API calls made while it is enabled, by service and method."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.enabled = False
+
+    def install(self):
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('bench', self.hook)
+
+    def hook(self, service, call, request, response):
+        if self.enabled:
+            self.calls['%s.%s' % (service, call)] += 1
+            self.request_bytes += request.ByteSize()
+            self.response_bytes += response.ByteSize()
+
+    def start(self):
+        self.calls.clear()
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        return {
+            'calls': dict(self.calls),
+            'datastore_calls': sum(n for name, n in self.calls.items()
+                                   if name.startswith('datastore_v3.')),
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+        }
+
+
+def peak_rss_kb():
+    """Returns the high-water mark of the process, not of a single case."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def random_word(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def make_lexicon(size, rng):
+    """Returns backup lines of size words, about half of them known."""
+    names = set()
+    while len(names) < size:
+        names.add(random_word(rng, rng.randint(3, 10)))
+    lines = []
+    for name in sorted(names):
+        obj = {
+            'name': name,
+            'conjugative': [name + 's'] if rng.random() < 0.2 else [],
+            'content': 'meaning of ' + name,
+            'known': rng.random() < 0.5,
+            'date': datetime(2018, 1, 1).strftime('%Y/%m/%d %H:%M:%S'),
+        }
+        lines.append(json.dumps(obj))
+    return sorted(names), '\n'.join(lines) + '\n'
+
+
+def make_document(size, names, rng):
+    """Returns a text of about size characters with headings and new words."""
+    out = []
+    length = 0
+    while length < size:
+        if rng.random() < 0.002:
+            line = '## ' + random_word(rng, 8)
+        else:
+            words = []
+            for _ in range(rng.randint(5, 30)):
+                if rng.random() < 0.1:
+                    word = random_word(rng, rng.randint(3, 10))
+                else:
+                    word = rng.choice(names) + rng.choice(SUFFIXES)
+                if rng.random() < 0.1:
+                    word = word.capitalize() + rng.choice('.,;:')
+                words.append(word)
+            line = ' '.join(words)
+        out.append(line)
+        length += len(line) + 1
+    return '\n'.join(out)[:size]
+
+
+class Bench(object):
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+        self.rpcs = RpcCounter()
+        self.testbed = None
+
+    def setup(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+        self.testbed.init_datastore_v3_stub(consistency_policy=policy)
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=APPENGINE_DIR)
+        self.testbed.init_user_stub()
+        self.testbed.setup_env(user_email=USER_EMAIL, user_id='1', user_is_admin='1',
+                               overwrite=True)
+        self.rpcs.install()
+        # imported after the stubs are registered
+        import db
+        import main
+        self.app = main.application
+        # queries see every write at once with this policy, so cold
+        # rebuilds of the forms are cached as in steady state
+        db.QUERY_CONSISTENCY_DELAY = -1
+
+    def teardown(self):
+        self.testbed.deactivate()
+
+    def request(self, path, method='GET', params=None):
+        # each request starts with an empty context cache, as in production
+        ndb.get_context().clear_cache()
+        body = urllib.urlencode(params or {})
+        if method == 'GET':
+            if body:
+                path += '?' + body
+            response = self.app.get_response(path)
+        else:
+            response = self.app.get_response(path, method='POST', body=body,
+                                             content_type='application/x-www-form-urlencoded')
+        if response.status_int >= 400:
+            raise RuntimeError('%s %s: %s' % (method, path, response.status))
+        return response
+
+    def run_tasks(self):
+        """Runs the enqueued tasks until the queues are empty."""
+        stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        while True:
+            tasks = stub.get_filtered_tasks()
+            if not tasks:
+                return
+            # the returned tasks do not carry their queue name
+            for queue in stub.GetQueues():
+                stub.FlushQueue(queue['name'])
+            for task in tasks:
+                ndb.get_context().clear_cache()
+                response = self.app.get_response(task.url, method='POST', body=task.payload,
+                                                 headers=dict(task.headers))
+                if response.status_int >= 400:
+                    raise RuntimeError('task %s: %s' % (task.url, response.status))
+
+    def measure(self, case, func, setup=None, repeat=None, **scale):
+        times = []
+        rpcs = None
+        for _ in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            self.rpcs.start()
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+            rpcs = self.rpcs.stop()
+        times.sort()
+        result = {
+            'case': case,
+            'latency_ms': {
+                'min': times[0] * 1000,
+                'median': times[len(times) // 2] * 1000,
+                'max': times[-1] * 1000,
+            },
+            'rpcs': rpcs,
+            'peak_rss_kb': peak_rss_kb(),
+        }
+        result.update(scale)
+        self.results.append(result)
+        sys.stderr.write('%-24s %-32s %10.1f ms %6d rpcs\n' % (
+            case, ' '.join('%s=%s' % item for item in sorted(scale.items())),
+            result['latency_ms']['median'], rpcs['datastore_calls']))
+        return result
+
+    def run_lexicon(self, num_words, doc_sizes, rng):
+        from db import Lexicon
+        from process import Processor
+
+        names, backup = make_lexicon(num_words, rng)
+        # once, a second restore of the same words writes nothing
+        self.measure('restore_words', lambda: self.request(
+            '/words/restore', 'POST', {'json': backup}), repeat=1, words=num_words)
+        self.run_tasks()
+        self.measure('backup_words', lambda: self.request('/words/backup', params={'gzip': '1'}),
+                     words=num_words)
+        self.measure('list_words', lambda: self.request('/words'), words=num_words)
+        self.measure('lexicon_forms_cold', Lexicon.get_forms_with_namespace,
+                     setup=memcache.flush_all, words=num_words)
+        self.measure('lexicon_forms_warm', Lexicon.get_forms_with_namespace, words=num_words)
+        word = rng.choice(names)
+        self.measure('show_word', lambda: self.request('/word', params={'name': word}),
+                     words=num_words)
+        self.measure('save_word', lambda: self.request(
+            '/word', 'POST', {'name': word, 'content': 'changed', 'known': 'known'}),
+            words=num_words)
+        self.run_tasks()
+
+        for size_kb in doc_sizes:
+            scale = {'words': num_words, 'document_kb': size_kb}
+            text = make_document(int(size_kb * 1024), names, rng)
+            self.measure('save_document', lambda: self.request(
+                '/doc/save', 'POST', {'id': '', 'title': 'bench', 'content': text}), **scale)
+            self.run_tasks()
+            id = max(key.id() for key in self.document_keys())
+            forms = Lexicon.get_forms_with_namespace()
+            self.measure('process_text', lambda: self.process(forms, text), **scale)
+            self.measure('build_collocation',
+                         lambda: Processor.build_collocation(text, defaultdict(list)), **scale)
+            self.measure('show_document_cold', lambda: self.request('/doc/%d' % id),
+                         setup=lambda: self.delete_renders(id), **scale)
+            self.measure('show_document_warm', lambda: self.request('/doc/%d' % id), **scale)
+            self.measure('show_document_client', lambda: self.request(
+                '/doc/%d' % id, params={'render': 'client'}), **scale)
+            self.measure('document_words', lambda: self.request('/doc/%d/words' % id), **scale)
+            if self.num_sections(text) > 1:
+                self.measure('document_section',
+                             lambda: self.request('/doc/%d/section/1' % id), **scale)
+        self.measure('index', lambda: self.request('/'), words=num_words)
+
+    @staticmethod
+    def process(forms, text):
+        from process import Processor
+        processor = Processor(forms=forms)
+        return processor.process_text(text)
+
+    @staticmethod
+    def num_sections(text):
+        from process import split_sections
+        return len(split_sections(text))
+
+    @staticmethod
+    def document_keys():
+        from db import Document, namespace_context
+        with namespace_context():
+            return Document.query().fetch(keys_only=True)
+
+    def delete_renders(self, id):
+        from google.appengine.ext import ndb
+        from db import RenderedDocument, namespace_context
+        with namespace_context():
+            ndb.delete_multi([RenderedDocument.key_for(id)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--words', default='1000,10000',
+                        help='lexicon sizes in words, comma separated')
+    parser.add_argument('--doc-sizes', default='1,100,1000',
+                        help='document sizes in kilobytes, comma separated')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='JSON output file, stdout by default')
+    args = parser.parse_args()
+
+    words = [int(s) for s in args.words.split(',')]
+    doc_sizes = [float(s) for s in args.doc_sizes.split(',')]
+    results = []
+    for num_words in words:
+        # a fresh datastore for each lexicon size
+        bench = Bench(args.repeat)
+        bench.setup()
+        try:
+            bench.run_lexicon(num_words, doc_sizes, random.Random(args.seed))
+        finally:
+            bench.teardown()
+        results += bench.results
+
+    report = {
+        'created': datetime.utcnow().isoformat(),
+        'python': sys.version.split()[0],
+        'args': vars(args),
+        'results': results,
+    }
+    out = open(args.output, 'w') if args.output else sys.stdout
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write('\n')
+
+
+if __name__ == '__main__':
+    main()
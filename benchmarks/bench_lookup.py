@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""Benchmarks the lexicon lookup of Processor.process_word per token.
+
+Compares a plain probe of the forms with the lemmatizer fallback, with a
+cold and a warm lemma cache. Needs the App Engine SDK importable, e.g.
+PYTHONPATH=<sdk root>/platform/google_appengine.
+
+    python benchmarks/bench_lookup.py --tokens 200000
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'appengine'))
+
+import lemmatize
+from formtable import FormTable
+from process import Processor
+
+SUFFIXES = ['', '', '', 's', 'es', 'ed', 'ing', 'er', 'est']
+
+
+def make_lexicon(vocabulary, rng):
+    forms = {}
+    for _ in range(vocabulary):
+        lemma = ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10)))
+        forms[lemma] = [lemma, rng.random() < 0.5]
+    return forms
+
+
+def make_tokens(count, forms, new_ratio, rng):
+    """Draws tokens with a Zipf-like frequency, inflecting some of them."""
+    lemmas = list(forms)
+    new_words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 12)))
+                 for _ in range(len(lemmas))]
+    tokens = []
+    for _ in range(count):
+        rank = int(rng.paretovariate(1.0)) - 1
+        if rng.random() < new_ratio:
+            tokens.append(new_words[rank % len(new_words)])
+        else:
+            tokens.append(lemmas[rank % len(lemmas)] + rng.choice(SUFFIXES))
+    return tokens
+
+
+def measure(func, tokens, repeat, setup=None):
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func(tokens)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def probe(forms):
+    def run(tokens):
+        for token in tokens:
+            forms.get(token)
+    return run
+
+
+def lookup(forms):
+    def run(tokens):
+        for token in tokens:
+            lemmatize.lookup(forms, token)
+    return run
+
+
+def process_words(forms):
+    processor = Processor(forms=FormTable.from_dict(forms))
+
+    def run(tokens):
+        for token in tokens:
+            processor.process_word(token)
+    return run
+
+
+def clear_cache():
+    lemmatize._cache = lemmatize.BoundedCache(lemmatize.CACHE_SIZE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tokens', type=int, default=200000)
+    parser.add_argument('--vocabulary', type=int, default=2000)
+    parser.add_argument('--new-ratio', type=float, default=0.1,
+                        help='share of tokens not derived from the lexicon')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # off by default in app.yaml; the fallback is what is measured
+    lemmatize.ENABLED = True
+    rng = random.Random(args.seed)
+    forms = make_lexicon(args.vocabulary, rng)
+    tokens = make_tokens(args.tokens, forms, args.new_ratio, rng)
+    cases = [
+        ('probe', probe(forms), None),
+        ('lookup, cold cache', lookup(forms), clear_cache),
+        ('lookup, warm cache', lookup(forms), None),
+        ('process_word', process_words(forms), None),
+    ]
+    print('%-20s %10s %12s' % ('case', 'total (s)', 'ns/token'))
+    for name, func, setup in cases:
+        elapsed = measure(func, tokens, args.repeat, setup)
+        print('%-20s %10.3f %12.0f' % (name, elapsed, elapsed / len(tokens) * 1e9))
+    cache = lemmatize._cache
+    print('lemma cache: %d entries, %d hits, %d misses' % (len(cache), cache.hits, cache.misses))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""Measures the cost of starting a new instance of the app.
+
+Times the imports of the app modules in fresh interpreters, and the
+first requests of a new instance against the App Engine testbed: cold,
+with the template bytecode already in memcache, and after a warmup
+request. Needs the App Engine SDK importable, e.g.
+PYTHONPATH=<sdk root>/platform/google_appengine:<sdk root>/platform/google_appengine/lib/webapp2-2.5.2:...
+
+    python benchmarks/bench_startup.py --repeat 5
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+APPENGINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'appengine')
+
+# each is imported alone in a fresh interpreter, so its time includes
+# whatever it imports itself
+MODULES = ['google.appengine.ext.ndb', 'webapp2', 'jinja2', 'db', 'process', 'collocation',
+           'stats', 'profiling', 'main']
+# words the tokenizer links may be non-ASCII, as in /word?name=café
+ROUTES = ['/', '/words', '/word?name=example', '/word?name=caf%C3%A9', '/words/frequent']
+CASES = ['cold', 'bytecode', 'warmup']
+USER_EMAIL = 'bench@example.com'
+
+IMPORT_CHILD = '''
+import sys, time
+sys.path.insert(0, %r)
+start = time.time()
+import %s
+sys.stdout.write(repr(time.time() - start))
+'''
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run_child(args):
+    output = subprocess.check_output([sys.executable] + args, cwd=APPENGINE_DIR)
+    return json.loads(output)
+
+
+def measure_imports(repeat):
+    results = []
+    for name in MODULES:
+        times = [run_child(['-c', IMPORT_CHILD % (APPENGINE_DIR, name)]) for _ in range(repeat)]
+        results.append((name, median(times)))
+    return results
+
+
+def first_requests(case):
+    """Runs in a fresh interpreter; returns the times of the first requests."""
+    sys.path.insert(0, APPENGINE_DIR)
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APPENGINE_DIR)
+    bed.init_user_stub()
+    bed.setup_env(user_email=USER_EMAIL, user_id='1', user_is_admin='1', overwrite=True)
+    times = {}
+    try:
+        start = time.time()
+        import main
+        times['import'] = time.time() - start
+        if case == 'bytecode':
+            # compiled by another instance, this one has only memcache
+            import jinja2
+            other = jinja2.Environment(loader=main.JINJA_ENVIRONMENT.loader,
+                                       extensions=['jinja2.ext.autoescape'], autoescape=True,
+                                       bytecode_cache=main.JINJA_ENVIRONMENT.bytecode_cache)
+            other.filters.update(main.JINJA_ENVIRONMENT.filters)
+            for name in other.list_templates(extensions=['html']):
+                other.get_template(name)
+        elif case == 'warmup':
+            start = time.time()
+            main.application.get_response('/_ah/warmup')
+            times['/_ah/warmup'] = time.time() - start
+        for path in ROUTES:
+            start = time.time()
+            response = main.application.get_response(path)
+            times[path] = time.time() - start
+            if response.status_int >= 400:
+                raise RuntimeError('%s: %s' % (path, response.status))
+    finally:
+        bed.deactivate()
+    return times
+
+
+def measure_requests(repeat):
+    results = {}
+    for case in CASES:
+        runs = [run_child([os.path.abspath(__file__), '--child', case]) for _ in range(repeat)]
+        results[case] = dict((key, median([run[key] for run in runs])) for key in runs[0])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5, help='fresh interpreters per case')
+    parser.add_argument('--child', choices=CASES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        json.dump(first_requests(args.child), sys.stdout)
+        return
+
+    print('%-28s %10s' % ('import', 'ms'))
+    for name, seconds in measure_imports(args.repeat):
+        print('%-28s %10.1f' % (name, seconds * 1000))
+    print('')
+
+    results = measure_requests(args.repeat)
+    print('%-28s' % 'first requests (ms)' + ''.join('%12s' % case for case in CASES))
+    for key in ['import', '/_ah/warmup'] + ROUTES:
+        row = [results[case].get(key) for case in CASES]
+        print('%-28s' % key + ''.join('%12s' % ('-' if ms is None else '%.1f' % (ms * 1000))
+                                      for ms in row))
+    for case in CASES:
+        total = sum(seconds for key, seconds in results[case].items() if key in ROUTES)
+        print('%-28s %.1f ms' % ('routes total, ' + case, total * 1000))
+
+
+if __name__ == '__main__':
+    main()
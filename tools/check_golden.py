@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""Checks the rendered HTML of a fixed corpus against its golden output.
+
+golden/corpus.html holds the line-by-line output of Processor.process_line
+for golden/corpus.txt, rendered against golden/lexicon.json by the
+recursive process_word the tokenizer replaced, with the word counts on
+its last line. Any change of the tokenizer or the word links must keep
+it byte-identical. Needs the App Engine SDK importable, e.g.
+PYTHONPATH=<sdk root>/platform/google_appengine.
+
+    python tools/check_golden.py
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'golden')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'appengine'))
+
+import lemmatize
+from formtable import FormTable
+from process import Processor
+
+
+def read_lines(name):
+    with io.open(os.path.join(GOLDEN_DIR, name), encoding='utf-8') as f:
+        return f.read().splitlines()
+
+
+def render(lines, lexicon):
+    processor = Processor(forms=FormTable.from_dict(lexicon))
+    output = [processor.process_line(line) for line in lines]
+    output.append(u'%d %d %d %d' % processor.counts())
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--update', action='store_true',
+                        help='rewrite the golden output after an intended change')
+    args = parser.parse_args()
+
+    # the golden output predates the lemmatizer fallback
+    lemmatize.ENABLED = False
+    with io.open(os.path.join(GOLDEN_DIR, 'lexicon.json'), encoding='utf-8') as f:
+        lexicon = json.load(f)
+    output = render(read_lines('corpus.txt'), lexicon)
+    if args.update:
+        with io.open(os.path.join(GOLDEN_DIR, 'corpus.html'), 'w', encoding='utf-8') as f:
+            f.write(u'\n'.join(output) + u'\n')
+        print('updated %d lines' % len(output))
+        return
+
+    expected = read_lines('corpus.html')
+    mismatches = 0
+    for number, (line, golden) in enumerate(zip(output, expected), 1):
+        if line != golden:
+            mismatches += 1
+            if mismatches <= 10:
+                print('line %d:\n  expected %s\n  rendered %s' % (
+                    number, golden.encode('utf-8'), line.encode('utf-8')))
+    if len(output) != len(expected):
+        mismatches += 1
+        print('%d lines rendered, %d expected' % (len(output), len(expected)))
+    if mismatches:
+        print('%d mismatches' % mismatches)
+        sys.exit(1)
+    print('%d lines identical' % len(output))
+
+
+if __name__ == '__main__':
+    main()
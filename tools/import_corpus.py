@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""Imports a directory of text files as documents of one user.
+
+Files are tokenized, counted, split into collocations and pre-rendered
+in a process pool; the results are merged and written to a local
+datastore file in put_multi batches, which dev_appserver.py can serve
+with --datastore_path. Needs the App Engine SDK importable, e.g.
+PYTHONPATH=<sdk root>/platform/google_appengine.
+
+    python tools/import_corpus.py corpus/ --email me@example.com \\
+        --datastore-path /tmp/vocabulary.datastore --app-id dev~vocabulary
+"""
+
+import argparse
+import contextlib
+import multiprocessing
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'appengine'))
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import collocation
+from db import BATCH_SIZE, NAMESPACE_TRANS, Collocation, Document, DocumentStats, FormIndex
+from db import DocumentCollocations, Lexicon, RenderedDocument, RenderedSection, namespace_context
+from formtable import FormTable
+from process import Processor, split_sections
+
+# set in each worker by init_worker
+_forms = None
+
+
+def init_worker(forms_blob):
+    global _forms
+    _forms = FormTable.loads(forms_blob) if forms_blob is not None else None
+
+
+def process_file(path):
+    """Processes one file; runs in a worker process."""
+    start = time.time()
+    with open(path) as f:
+        content = f.read().decode('utf-8')
+    title = os.path.splitext(os.path.basename(path))[0]
+
+    processor = Processor(neutral=True)
+    for text in (title, content):
+        for _ in processor.iter_text(text):
+            pass
+    result = {
+        'path': path,
+        'title': title,
+        'content': content,
+        'counter': dict(processor.counter),
+        'collocations': dict(collocation.document_collocations(content)),
+        'sections': [],
+    }
+    if _forms is not None:
+        for i, lines in enumerate(split_sections(content)):
+            processor = Processor(forms=_forms)
+            entries = list(processor.iter_line_entries(lines))
+            result['sections'].append({
+                'title': processor.process_text(title) if i == 0 else None,
+                'lines': entries,
+                'forms': list(processor.dependent_forms()),
+                'counts': processor.counts(),
+            })
+    result['seconds'] = time.time() - start
+    return result
+
+
+class Timer(object):
+    """Accumulates the wall time of named stages."""
+
+    def __init__(self):
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.time() - start))
+
+    def report(self, out=sys.stdout):
+        total = sum(seconds for _, seconds in self.stages)
+        for name, seconds in self.stages:
+            out.write('%-24s %10.2f s %6.1f%%\n' % (name, seconds, 100 * seconds / (total or 1)))
+        out.write('%-24s %10.2f s\n' % ('total', total))
+
+
+def batches(items, size=BATCH_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def write_documents(results, namespace):
+    documents = [Document(namespace=namespace, title=r['title'], content=r['content'], revision=1)
+                 for r in results]
+    for batch in batches(documents):
+        ndb.put_multi(batch)
+    return [document.key.id() for document in documents]
+
+
+def write_stats(results, ids, lexicon, forms, namespace):
+    stats = []
+    index = defaultdict(dict)
+    for result, id in zip(results, ids):
+        s = DocumentStats(id=id, namespace=namespace, revision=1,
+                          lexicon_version=lexicon.version, counter=result['counter'])
+        s.count(forms)
+        stats.append(s)
+        for form, count in result['counter'].iteritems():
+            index[form][id] = count
+    for batch in batches(stats):
+        ndb.put_multi(batch)
+    for names in batches(sorted(index)):
+        indexes = FormIndex.get_multi_by_form_or_new_with_namespace(names)
+        for form_index in indexes:
+            for id, count in sorted(index[form_index.key.id()].iteritems()):
+                form_index.set_count(id, count)
+            form_index.set_state(forms)
+        ndb.put_multi(indexes)
+    return len(index)
+
+
+def write_collocations(results, ids, namespace):
+    states = [DocumentCollocations(id=id, namespace=namespace, revision=1,
+                                   digests=collocation.collocation_digests(result['collocations']))
+              for result, id in zip(results, ids)]
+    for batch in batches(states):
+        ndb.put_multi(batch)
+    merged = defaultdict(list)
+    # newest document first, in the order of a rebuild
+    for result, id in reversed(zip(results, ids)):
+        for name, collocations in result['collocations'].iteritems():
+            merged[name].append((id, collocations))
+    for names in batches(sorted(merged)):
+        colls = Collocation.get_multi_by_name_or_new_with_namespace(names)
+        for coll in colls:
+            if coll.entries is None:
+                coll.entries = []
+                coll.documents = []
+            for id, collocations in merged[coll.name]:
+                collocation.add_document(coll, id, collocations)
+        ndb.put_multi(colls)
+    return len(merged)
+
+
+def write_renders(results, ids, lexicon, namespace):
+    renders = []
+    for result, id in zip(results, ids):
+        for i, section in enumerate(result['sections']):
+            key = RenderedDocument.key_for(id, i)
+            model = RenderedDocument if i == 0 else RenderedSection
+            words, known, unknown, new = section['counts']
+            renders.append(model(id=key.id(), namespace=namespace, revision=1,
+                                 lexicon_version=lexicon.version, neutral=False,
+                                 title=section['title'], lines=section['lines'],
+                                 forms=section['forms'], count_words=words,
+                                 count_known_words=known, count_unknown_words=unknown,
+                                 count_new_words=new,
+                                 num_sections=len(result['sections']) if i == 0 else None))
+    for batch in batches(renders):
+        ndb.put_multi(batch)
+    return len(renders)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('directory')
+    parser.add_argument('--email', required=True, help='owner of the documents')
+    parser.add_argument('--datastore-path', required=True,
+                        help='datastore file, created if missing')
+    parser.add_argument('--app-id', default='dev~vocabulary')
+    parser.add_argument('--extension', default='.txt')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--no-render', action='store_true',
+                        help='skip rendering, documents are rendered when first viewed')
+    args = parser.parse_args()
+
+    paths = sorted(os.path.join(root, name)
+                   for root, _, names in os.walk(args.directory)
+                   for name in names if name.endswith(args.extension))
+    namespace = args.email.translate(NAMESPACE_TRANS)
+    timer = Timer()
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id=args.app_id, user_email=args.email, overwrite=True)
+    # the sqlite stub writes through to the file, as dev_appserver.py does
+    bed.init_datastore_v3_stub(datastore_file=args.datastore_path, use_sqlite=True)
+    bed.init_memcache_stub()
+    try:
+        with namespace_context(namespace):
+            with timer.stage('load lexicon'):
+                lexicon = Lexicon.get_with_namespace()
+                forms = Lexicon.get_forms_with_namespace(lexicon)
+
+            with timer.stage('process (%d workers)' % args.workers):
+                forms_blob = None if args.no_render else forms.dumps()
+                pool = multiprocessing.Pool(args.workers, init_worker, (forms_blob,))
+                try:
+                    chunksize = max(1, len(paths) // (4 * args.workers))
+                    results = pool.map(process_file, paths, chunksize=chunksize)
+                finally:
+                    pool.close()
+                    pool.join()
+
+            with timer.stage('write documents'):
+                ids = write_documents(results, namespace)
+            with timer.stage('write stats'):
+                num_forms = write_stats(results, ids, lexicon, forms, namespace)
+            with timer.stage('write collocations'):
+                num_collocations = write_collocations(results, ids, namespace)
+            with timer.stage('write renders'):
+                num_renders = write_renders(results, ids, lexicon, namespace)
+    finally:
+        bed.deactivate()
+
+    worker_seconds = sum(result['seconds'] for result in results)
+    size = sum(len(result['content']) for result in results)
+    print('%d documents, %.1f MB, %d forms, %d collocations, %d renders' % (
+        len(results), size / 1048576.0, num_forms, num_collocations, num_renders))
+    print('worker time %.2f s, %.2f MB/s per worker' % (
+        worker_seconds, size / 1048576.0 / (worker_seconds or 1)))
+    timer.report()
+
+
+if __name__ == '__main__':
+    main()